@@ -82,6 +82,7 @@ class BzComment(object):
 
 class BzAttachment(object):
     def __init__(self, name):
+        self.id = None
         self.created = None
         self.reporter = ""
         self.name = name
@@ -1,8 +1,10 @@
 import MySQLdb
 import MySQLdb.cursors
 from youtrackutils.bugzilla import *
+import tempfile
 import time
 from youtrackutils import bugzilla
+from youtrackutils.utils.usercache import UserCache
 
 
 class Client(object):
@@ -10,6 +12,11 @@ class Client(object):
         self.sql_cnx = MySQLdb.connect(host=host, port=port, user=login, passwd=password,
                                        db=db_name, cursorclass=MySQLdb.cursors.DictCursor, charset=bugzilla.BZ_DB_CHARSET)
         self.db_host = "%s:%s/" % (host, str(port))
+        # Schema probes don't change during an import, so ask the server once
+        self._table_exists = dict([])
+        self._column_exists = dict([])
+        self._cf_types = None
+        self.user_cache = UserCache(self._load_users, self._load_user)
 
     def get_project_description(self, product_id):
         cursor = self.sql_cnx.cursor()
@@ -104,17 +111,26 @@ class Client(object):
         return result
 
     def _get_component_by_id(self, component_id):
+        return self._get_components_by_ids([component_id]).get(component_id, "No subsystem")
+
+    def _get_components_by_ids(self, component_ids):
+        result = dict([])
+        if not len(component_ids):
+            return result
         cursor = self.sql_cnx.cursor()
-        name_row = 'name'
-        request = "SELECT %s FROM components WHERE id = %s" % (name_row, component_id)
+        request = "SELECT id, name FROM components WHERE id IN (%s)" % self._to_sql_list(component_ids)
         cursor.execute(request)
-        result = cursor.fetchone()
-        if result is None:
-            return "No subsystem"
-        else:
-            return result[name_row]
+        for row in cursor:
+            result[row["id"]] = row["name"]
+        return result
 
     def get_issues(self, product_id, from_id, to_id):
+        return self._get_issues(product_id, "bug_id BETWEEN %d AND %d" % (from_id, to_id - 1))
+
+    def get_issues_after(self, product_id, after_id, max_count):
+        return self._get_issues(product_id, "bug_id > %d" % after_id, max_count)
+
+    def _get_issues(self, product_id, condition, limit=None):
         component_row = "component_id"
         user_rows = ["assigned_to", "qa_contact", "reporter"]
 
@@ -127,8 +143,10 @@ class Client(object):
                 WHERE
                     product_id=%s
                 AND
-                    bug_id BETWEEN %d AND %d
-                ''' % (product_id, from_id, to_id - 1)
+                    %s
+                ORDER BY
+                    bug_id
+                ''' % (product_id, condition)
         else:
             query = '''
                 SELECT
@@ -145,30 +163,52 @@ class Client(object):
                 WHERE
                     b.product_id=%s
                 AND
-                    b.bug_id BETWEEN %d AND %d
+                    b.%s
                 GROUP BY
                     b.bug_id
-                ''' % (product_id, from_id, to_id - 1)
+                ORDER BY
+                    b.bug_id
+                ''' % (product_id, condition)
+        if limit is not None:
+            query += "LIMIT %d" % limit
 
         cursor = self.sql_cnx.cursor()
         cursor.execute(query)
+        rows = list(cursor)
+        if not len(rows):
+            return []
+
+        # Child tables are loaded once for the whole window and stitched
+        # together in memory instead of querying them for every bug
+        ids = [row["bug_id"] for row in rows]
+        components = self._get_components_by_ids(
+            set([row[component_row] for row in rows if component_row in row]))
+        users = self._get_users_by_ids(
+            set([row[user_row] for row in rows for user_row in user_rows
+                 if row.get(user_row) is not None]))
+        flags = self._get_flags_by_ids(ids)
+        voters = self._get_voters_by_ids(ids)
+        cf_values = self._get_cf_values_by_ids(ids, rows)
+        comments = self._get_comments_by_ids(ids)
+        attachments = self._get_attachments_by_ids(ids)
+        cc = self._get_cc_by_ids(ids)
 
         result = []
-        for row in cursor:
+        for row in rows:
             if component_row in row:
-                row["component"] = self._get_component_by_id(row[component_row])
+                row["component"] = components.get(row[component_row], "No subsystem")
             for user_row in user_rows:
                 if user_row in row:
                     user_row_value = row[user_row]
                     if user_row_value is not None:
-                        row[user_row] = self.get_user_by_id(user_row_value)
+                        row[user_row] = users[user_row_value]
             id = row["bug_id"]
-            row["flags"] = self.get_flags_by_id(id)
-            row["voters"] = self.get_voters_by_id(id)
-            row.update(self.get_cf_values_by_id(id))
-            row["comments"] = self.get_comments_by_id(id)
-            row["attachments"] = self.get_attachments_by_id(id)
-            row["cc"] = self._get_cc_by_id(id)
+            row["flags"] = flags.get(id, set([]))
+            row["voters"] = voters.get(id, list([]))
+            row.update(cf_values.get(id, dict([])))
+            row["comments"] = comments.get(id, list([]))
+            row["attachments"] = attachments.get(id, list([]))
+            row["cc"] = cc.get(id, list([]))
             row["estimated_time"] = int(row["estimated_time"])
             row["keywords"] = set([kw.strip() for kw in row["keywords"].split(",") if len(kw.strip())])
             for key in row.keys():
@@ -183,13 +223,16 @@ class Client(object):
         return int(cursor.fetchone()["COUNT(*)"])
 
     def _get_cc_by_id(self, id):
-        cc_cursor = self.sql_cnx.cursor()
+        return self._get_cc_by_ids([id]).get(id, list([]))
+
+    def _get_cc_by_ids(self, bug_ids):
         who_row = 'who'
-        request = "SELECT %s FROM cc WHERE bug_id = %s" % (who_row, id)
-        cc_cursor.execute(request)
-        result = []
-        for cc in cc_cursor :
-            result.append(self.get_user_by_id(cc[who_row]))
+        request = "SELECT bug_id, %s FROM cc WHERE bug_id IN (%s)" % (who_row, self._to_sql_list(bug_ids))
+        rows = self._get_rows_by_bug_id(request)
+        users = self._get_users_by_ids(set([r[who_row] for bug_rows in rows.values() for r in bug_rows]))
+        result = dict([])
+        for bug_id, bug_rows in rows.items():
+            result[bug_id] = [users[r[who_row]] for r in bug_rows]
         return result
 
     def get_duplicate_links(self):
@@ -221,6 +264,20 @@ class Client(object):
         return result
 
     def get_user_by_id(self, id):
+        return self.user_cache.get(id)
+
+    def _get_users_by_ids(self, ids):
+        result = dict([])
+        for id in ids:
+            result[id] = self.user_cache.get(id)
+        return result
+
+    def _load_users(self):
+        cursor = self.sql_cnx.cursor()
+        cursor.execute("SELECT login_name, realname, userid FROM profiles")
+        return [(row["userid"], self._to_user(row)) for row in cursor]
+
+    def _load_user(self, id):
         cursor = self.sql_cnx.cursor()
         login_name = 'login_name'
         real_name = "realname"
@@ -228,119 +285,198 @@ class Client(object):
         request = "SELECT %s, %s, %s FROM profiles WHERE userid = %s" %  (login_name, real_name, user_id, id)
         cursor.execute(request)
         result = cursor.fetchone()
-        user = BzUser(result[user_id])
-        user.login = result[login_name]
-        user.email = result[login_name]
-        user.full_name = result[real_name]
+        return self._to_user(result)
+
+    def _to_user(self, row):
+        user = BzUser(row["userid"])
+        user.login = row["login_name"]
+        user.email = row["login_name"]
+        user.full_name = row["realname"]
         return user
 
     def get_cf_values_by_id(self, bug_id):
-        existing_custom_fields = self.get_custom_fields()
+        return self._get_cf_values_by_ids([bug_id]).get(bug_id, dict([]))
 
+    def _get_cf_values_by_ids(self, bug_ids, bug_rows=None):
         single_fields = list([])
         multiple_fields = list([])
-        for cf in existing_custom_fields:
-            if cf.type == '3' :
-                multiple_fields.append(cf.name)
+        for name, type in self._get_cf_types():
+            if type == '3':
+                multiple_fields.append(name)
             else:
-                single_fields.append(cf.name)
+                single_fields.append(name)
 
         result = dict([])
-        sing_cursor = self.sql_cnx.cursor()
+        for bug_id in bug_ids:
+            result[bug_id] = dict([])
         if len(single_fields):
-            request = "SELECT "
-            for elem in single_fields:
-                request = request + "cf_" + elem + ", "
-            request = request[:-2]
-            request += " FROM bugs WHERE bug_id = %s" % (str(bug_id))
-            sing_cursor.execute(request)
-            for row in sing_cursor:
+            if bug_rows is None:
+                request = "SELECT bug_id, "
+                for elem in single_fields:
+                    request = request + "cf_" + elem + ", "
+                request = request[:-2]
+                request += " FROM bugs WHERE bug_id IN (%s)" % self._to_sql_list(bug_ids)
+                sing_cursor = self.sql_cnx.cursor()
+                sing_cursor.execute(request)
+                bug_rows = sing_cursor
+            for row in bug_rows:
                 for elem in single_fields:
                     elem_row = "cf_" + elem
                     if (row[elem_row] != "---") and (row[elem_row] is not None):
-                        result[elem] = row[elem_row]
+                        result[row['bug_id']][elem] = row[elem_row]
         for cf in multiple_fields:
+            for bug_id in bug_ids:
+                result[bug_id][cf] = list([])
             mult_cursor = self.sql_cnx.cursor()
-            mult_cursor.execute("SELECT value FROM bug_cf_" + cf + " WHERE bug_id = %s" % str(bug_id))
-            result[cf] = list([])
+            mult_cursor.execute("SELECT bug_id, value FROM bug_cf_" + cf +
+                                " WHERE bug_id IN (%s)" % self._to_sql_list(bug_ids))
             for row in mult_cursor:
                 if row['value'] != '---':
-                    result[cf].append(row['value'])
+                    result[row['bug_id']][cf].append(row['value'])
         return result
 
+    def _get_cf_types(self):
+        if self._cf_types is None:
+            cursor = self.sql_cnx.cursor()
+            cursor.execute("SELECT name, type FROM fielddefs WHERE (custom = 1) AND NOT (type = 6)")
+            self._cf_types = [(row['name'][3:], str(row['type'])) for row in cursor]
+        return self._cf_types
+
     def get_comments_by_id(self, bug_id):
-        result = list([])
-        cursor = self.sql_cnx.cursor()
+        return self._get_comments_by_ids([bug_id]).get(bug_id, list([]))
+
+    def _get_comments_by_ids(self, bug_ids):
         when_row = 'bug_when'
         who_row = 'who'
         text_row = 'thetext'
-        request = "SELECT %s, %s, %s FROM longdescs WHERE bug_id = %s" % (when_row, who_row, text_row, str(bug_id))
-        cursor.execute(request)
-        for row in cursor:
-            comment = BzComment(time.mktime(row[when_row].timetuple()) + 1e-6 * row[when_row].microsecond)
-            comment.reporter = self.get_user_by_id(row[who_row])
-            comment.content = row[text_row]
-            result.append(comment)
+        request = "SELECT bug_id, %s, %s, %s FROM longdescs WHERE bug_id IN (%s)" % (
+            when_row, who_row, text_row, self._to_sql_list(bug_ids))
+        rows = self._get_rows_by_bug_id(request)
+        users = self._get_users_by_ids(set([r[who_row] for bug_rows in rows.values() for r in bug_rows]))
+        result = dict([])
+        for bug_id, bug_rows in rows.items():
+            result[bug_id] = list([])
+            for row in bug_rows:
+                comment = BzComment(time.mktime(row[when_row].timetuple()) + 1e-6 * row[when_row].microsecond)
+                comment.reporter = users[row[who_row]]
+                comment.content = row[text_row]
+                result[bug_id].append(comment)
         return result
 
     def get_attachments_by_id(self, bug_id):
-        def get_attach_data_table():
-            cursor = self.sql_cnx.cursor()
-            cursor.execute("show tables like 'attach_data'")
-            if cursor.fetchone():
-                return 'attach_data'
-            return 'attachments'
-        result = list([])
-        cursor = self.sql_cnx.cursor()
+        return self._get_attachments_by_ids([bug_id]).get(bug_id, list([]))
+
+    def _get_attachments_by_ids(self, bug_ids):
         id_row = 'attach_id'
         created_row = 'creation_ts'
         filename_row = 'filename'
         submitter_row = 'submitter_id'
-        attach_data_table = get_attach_data_table()
-        attach_data_table_id_row = 'id' if attach_data_table == 'attach_data' else 'attach_id'
-        request = "SELECT %s, %s, %s, %s " % (id_row, created_row, filename_row, submitter_row)
-        request += "FROM attachments WHERE bug_id = %s" % str(bug_id)
-        cursor.execute(request)
-        for row in cursor:
-            file_cursor = self.sql_cnx.cursor()
-            data_row = 'thedata'
-            file_request = "SELECT %s FROM %s WHERE %s = %s" % (data_row, attach_data_table, attach_data_table_id_row, str(row[id_row]))
-            file_cursor.execute(file_request)
-            attach_row = file_cursor.fetchone()
-            if attach_row is None:
-                continue
-            attach = BzAttachment(row[filename_row])
-            attach.content = attach_row[data_row]
-            attach.reporter = self.get_user_by_id(row[submitter_row])
-            attach.created = time.mktime(row[created_row].timetuple()) + 1e-6 * row[created_row].microsecond
-            result.append(attach)
+        request = "SELECT bug_id, %s, %s, %s, %s " % (id_row, created_row, filename_row, submitter_row)
+        request += "FROM attachments WHERE bug_id IN (%s)" % self._to_sql_list(bug_ids)
+        rows = self._get_rows_by_bug_id(request)
+        attach_ids = [r[id_row] for bug_rows in rows.values() for r in bug_rows]
+        with_data = self._get_attachments_with_data(attach_ids)
+        users = self._get_users_by_ids(set([r[submitter_row] for bug_rows in rows.values() for r in bug_rows]))
+        result = dict([])
+        for bug_id, bug_rows in rows.items():
+            result[bug_id] = list([])
+            for row in bug_rows:
+                if row[id_row] not in with_data:
+                    continue
+                attach = BzAttachment(row[filename_row])
+                attach.id = row[id_row]
+                attach.reporter = users[row[submitter_row]]
+                attach.created = time.mktime(row[created_row].timetuple()) + 1e-6 * row[created_row].microsecond
+                result[bug_id].append(attach)
         return result
 
-    def get_flags_by_id(self, bug_id):
+    def _get_attach_data_table(self):
+        if self.check_table_exists('attach_data'):
+            return 'attach_data', 'id'
+        return 'attachments', 'attach_id'
+
+    def _get_attachments_with_data(self, attach_ids):
         result = set([])
+        if not len(attach_ids):
+            return result
+        attach_data_table, attach_data_table_id_row = self._get_attach_data_table()
         cursor = self.sql_cnx.cursor()
-        type_row = 'type_id'
-        request = "SELECT %s FROM flags WHERE (bug_id = %s) AND (status = '+')" % (type_row, str(bug_id))
+        request = "SELECT %s AS id FROM %s WHERE %s IN (%s)" % (
+            attach_data_table_id_row, attach_data_table,
+            attach_data_table_id_row, self._to_sql_list(attach_ids))
+        if attach_data_table == 'attachments':
+            request += " AND thedata IS NOT NULL"
         cursor.execute(request)
         for row in cursor:
-            flag_cursor = self.sql_cnx.cursor()
-            name_row = 'name'
-            flag_request = "SELECT %s FROM flagtypes WHERE id = %s LIMIT 1" % (name_row, str(row[type_row]))
-            flag_cursor.execute(flag_request)
-            result.add(flag_cursor.fetchone()[name_row].encode('utf8'))
+            result.add(row['id'])
+        return result
+
+    def get_attachment_content(self, attachment, max_memory_size=1024 * 1024):
+        # Blobs are fetched in pieces of max_memory_size and spooled to disk
+        # when large, so reading one doesn't hold more than max_memory_size.
+        # Contents stay open until they are uploaded, callers should read a
+        # blob only when its upload is about to be queued
+        attach_data_table, attach_data_table_id_row = self._get_attach_data_table()
+        data_row = 'thedata'
+        request = "SELECT SUBSTRING(%s, %%s, %%s) AS %s FROM %s WHERE %s = %s" % (
+            data_row, data_row, attach_data_table, attach_data_table_id_row,
+            str(attachment.id))
+        cursor = self.sql_cnx.cursor()
+        result = tempfile.SpooledTemporaryFile(max_size=max_memory_size)
+        try:
+            position = 1
+            while True:
+                cursor.execute(request, (position, max_memory_size))
+                row = cursor.fetchone()
+                if row is None or row[data_row] is None:
+                    break
+                result.write(row[data_row])
+                if len(row[data_row]) < max_memory_size:
+                    break
+                position += max_memory_size
+        finally:
+            cursor.close()
+        result.seek(0)
+        return result
+
+    def get_flags_by_id(self, bug_id):
+        return self._get_flags_by_ids([bug_id]).get(bug_id, set([]))
+
+    def _get_flags_by_ids(self, bug_ids):
+        name_row = 'name'
+        request = "SELECT f.bug_id, t.%s FROM flags f JOIN flagtypes t ON t.id = f.type_id " % name_row
+        request += "WHERE (f.bug_id IN (%s)) AND (f.status = '+')" % self._to_sql_list(bug_ids)
+        result = dict([])
+        for bug_id, bug_rows in self._get_rows_by_bug_id(request).items():
+            result[bug_id] = set([row[name_row].encode('utf8') for row in bug_rows])
         return result
 
     def get_voters_by_id(self, bug_id):
-        result = list([])
+        return self._get_voters_by_ids([bug_id]).get(bug_id, list([]))
+
+    def _get_voters_by_ids(self, bug_ids):
+        result = dict([])
         if self.check_table_exists('votes'):
-            cursor = self.sql_cnx.cursor()
             who_row = 'who'
-            request = "SELECT %s FROM votes WHERE bug_id=%s" % (who_row, str(bug_id))
-            cursor.execute(request)
-            for row in cursor:
-                result.append(self.get_user_by_id(row[who_row]))
+            request = "SELECT bug_id, %s FROM votes WHERE bug_id IN (%s)" % (who_row, self._to_sql_list(bug_ids))
+            rows = self._get_rows_by_bug_id(request)
+            users = self._get_users_by_ids(set([r[who_row] for bug_rows in rows.values() for r in bug_rows]))
+            for bug_id, bug_rows in rows.items():
+                result[bug_id] = [users[r[who_row]] for r in bug_rows]
+        return result
+
+    def _get_rows_by_bug_id(self, request):
+        cursor = self.sql_cnx.cursor()
+        cursor.execute(request)
+        result = dict([])
+        for row in cursor:
+            result.setdefault(row['bug_id'], list([])).append(row)
         return result
 
+    @staticmethod
+    def _to_sql_list(ids):
+        return ", ".join([str(int(id)) for id in ids])
+
     def _get_product_id_by_bug_id(self, bug_id):
         cursor = self.sql_cnx.cursor()
         id_row = "product_id"
@@ -368,12 +504,16 @@ class Client(object):
         return result
 
     def check_table_exists(self, table_name):
-        cursor = self.sql_cnx.cursor()
-        request = "SHOW TABLES LIKE '%s'" % table_name
-        return cursor.execute(request) > 0
+        if table_name not in self._table_exists:
+            cursor = self.sql_cnx.cursor()
+            request = "SHOW TABLES LIKE '%s'" % table_name
+            self._table_exists[table_name] = cursor.execute(request) > 0
+        return self._table_exists[table_name]
 
     def check_column_exists(self, table_name, column_name):
-        cursor = self.sql_cnx.cursor()
-        request = "SHOW COLUMNS FROM %s LIKE '%s'" % (table_name, column_name)
-        return cursor.execute(request) > 0
-        
+        key = (table_name, column_name)
+        if key not in self._column_exists:
+            cursor = self.sql_cnx.cursor()
+            request = "SHOW COLUMNS FROM %s LIKE '%s'" % (table_name, column_name)
+            self._column_exists[key] = cursor.execute(request) > 0
+        return self._column_exists[key]
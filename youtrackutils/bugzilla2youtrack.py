@@ -13,12 +13,15 @@ import youtrack
 from youtrack.connection import Connection, utf8encode
 from youtrackutils.bugzilla.bzClient import Client
 from youtrack import *
-from StringIO import StringIO
 import youtrackutils.bugzilla.defaultBzMapping
 import youtrackutils.bugzilla
 import os
 import urllib2
 from youtrack.importHelper import create_custom_field, process_custom_field
+from youtrackutils.utils.attachments import AttachmentUploader, \
+    DEFAULT_WORKERS
+from youtrackutils.utils.journal import Journal, journal_path, link_key
+from youtrackutils.utils.pipeline import Pipeline
 
 # Enable unbuffered output
 sys.stdout = os.fdopen(sys.stdout.fileno(), 'w', 0)
@@ -72,6 +75,13 @@ Options:
          YouTrack user password
     -m MAPPING_FILE,
          Path to mapping file that maps columns from csv to YouTrack fields
+    -j WORKERS,
+         Number of attachments to upload in parallel (default %d)
+    -R RATE,
+         Max number of attachment uploads per second (not limited by default)
+    --resume
+         Continue an interrupted import skipping the work that was already
+         done (uses the journal file in the current directory)
 
 Examples:
 
@@ -85,13 +95,14 @@ Examples:
     $ %s -T token https://youtrack.company.com bugs localhost 3306 bz bz
 
 
-""" % (basename, help_url, basename, basename))
+""" % (basename, help_url, DEFAULT_WORKERS, basename, basename))
 
 
 def main():
     try:
         params = {}
-        opts, args = getopt.getopt(sys.argv[1:], 'hgu:p:m:t:T:')
+        opts, args = getopt.getopt(sys.argv[1:], 'hgu:p:m:t:T:j:R:',
+                                   ['resume'])
         for opt, val in opts:
             if opt == '-h':
                 usage()
@@ -108,7 +119,13 @@ def main():
                 params['token'] = val
             elif opt == '-T':
                 check_file_and_save(val, params, 'token_file')
-    except getopt.GetoptError as e:
+            elif opt == '-j':
+                params['attachment_workers'] = int(val)
+            elif opt == '-R':
+                params['attachment_rate'] = float(val)
+            elif opt == '--resume':
+                params['resume'] = True
+    except (getopt.GetoptError, ValueError) as e:
         print(e)
         usage()
         sys.exit(1)
@@ -408,13 +425,84 @@ def get_yt_field_value_from_bz_field_value(bz_value):
     return bz_value
 
 
+def read_issues(client, product_id, max_count):
+    """Yields batches of product issues."""
+    last_id = 0
+    while True:
+        batch = client.get_issues_after(product_id, last_id, max_count)
+        if not len(batch):
+            return
+        last_id = batch[-1]["bug_id"]
+        yield batch
+
+
+def import_batch(target, uploader, blob_client, journal, product_id,
+                 imported_id, batch):
+    last_id = batch[-1]["bug_id"]
+    if last_id > imported_id:
+        target.importIssues(product_id, product_id + " assignees",
+            [to_yt_issue(bz_issue, product_id, target) for bz_issue in batch])
+        # todo convert to good tags import
+        for issue in batch:
+            tags = issue["keywords"] | issue["flags"]
+            for t in tags:
+                print("Processing tag [ %s ]" % t.encode('utf8'))
+                target.executeCommand(str(product_id) + "-" + str(issue[get_number_in_project_field_name()]),
+                    "tag " + t.encode('utf8'))
+        journal.set_position(product_id, last_id)
+    for issue in batch:
+        issue_id = str(product_id) + '-' + \
+                   str(issue[get_number_in_project_field_name()])
+        for attach in issue["attachments"]:
+            if journal.has('attachment', attach.id):
+                continue
+            print("Processing attachment [ %s ] for issue %s" %
+                  (utf8encode(attach.name), issue_id))
+            import_attachment(uploader, target, blob_client, journal,
+                              issue_id, attach)
+
+
+def import_attachment(uploader, target, blob_client, journal, issue_id,
+                      attach):
+    # The blob is read just before it's queued, so submit() blocking on a
+    # full uploader also stops further reads. The connection is used only
+    # by the import stage, the one of the read stage can't be shared.
+    content = blob_client.get_attachment_content(attach)
+    content.seek(0, os.SEEK_END)
+    size = content.tell()
+
+    def upload():
+        content.seek(0)
+        try:
+            # with the length known the content is streamed as it is,
+            # otherwise the library copies it to a temporary file
+            target.importAttachment(
+                issue_id, attach.name, content, attach.reporter.login,
+                None, size, str(int(attach.created) * 1000))
+        except urllib2.HTTPError as e:
+            if e.code == 413:
+                print("Please check Max Upload File Size in YouTrack")
+            raise
+
+    def on_done(ok):
+        content.close()
+        if ok:
+            journal.add('attachment', attach.id)
+
+    uploader.submit(issue_id, attach.name, upload, size, on_done)
+
+
+def connect_bugzilla(params):
+    return Client(host=params['bz_host'],
+                  port=int(params['bz_port']),
+                  login=params['bz_login'],
+                  password=params['bz_password'],
+                  db_name=params['bz_db'])
+
+
 def bugzilla2youtrack(params):
     # Connecting to Bugzilla
-    client = Client(host=params['bz_host'],
-                    port=int(params['bz_port']),
-                    login=params['bz_login'],
-                    password=params['bz_password'],
-                    db_name=params['bz_db'])
+    client = connect_bugzilla(params)
 
     bz_product_names = params.get('bz_product_names')
     if not bz_product_names:
@@ -445,88 +533,77 @@ def bugzilla2youtrack(params):
         print("You have to provide token or login/password to import data")
         sys.exit(1)
 
-    print("Creating issue link types")
-    link_types = client.get_issue_link_types()
-    for link in link_types:
-        print("Processing link type [ %s ]" % link.name)
-        try:
-            target.createIssueLinkType(to_yt_issue_link_type(link))
-        except YouTrackException:
-            print("Can't create link type [ %s ] (maybe because it already exists)" % link.name)
-    print("Creating issue link types finished")
-
-    print("Creating custom fields")
-    custom_fields = client.get_custom_fields()
-    for cf in custom_fields:
-        create_yt_custom_field(cf, target)
-    print("Creating custom fields finished")
+    journal = Journal(journal_path('bugzilla2youtrack'), params.get('resume'))
 
-    for key in youtrackutils.bugzilla.FIELD_TYPES:
-        if key not in youtrack.EXISTING_FIELDS:
-            create_custom_field(target, youtrackutils.bugzilla.FIELD_TYPES[key], key, True, bundle_policy="1")
+    if not journal.is_done('link_types'):
+        print("Creating issue link types")
+        link_types = client.get_issue_link_types()
+        for link in link_types:
+            print("Processing link type [ %s ]" % link.name)
+            try:
+                target.createIssueLinkType(to_yt_issue_link_type(link))
+            except YouTrackException:
+                print("Can't create link type [ %s ] (maybe because it already exists)" % link.name)
+        journal.done('link_types')
+        print("Creating issue link types finished")
+
+    if not journal.is_done('custom_fields'):
+        print("Creating custom fields")
+        custom_fields = client.get_custom_fields()
+        for cf in custom_fields:
+            create_yt_custom_field(cf, target)
+        print("Creating custom fields finished")
+
+        for key in youtrackutils.bugzilla.FIELD_TYPES:
+            if key not in youtrack.EXISTING_FIELDS:
+                create_custom_field(target, youtrackutils.bugzilla.FIELD_TYPES[key], key, True, bundle_policy="1")
+        journal.done('custom_fields')
 
     bz_product_ids = []
+    uploader = AttachmentUploader(
+        params['yt_url'],
+        workers=params.get('attachment_workers', DEFAULT_WORKERS),
+        rate=params.get('attachment_rate'))
+
+    # attachment contents are read by the import stage of the pipeline
+    blob_client = connect_bugzilla(params)
 
     for name in bz_product_names:
         product_id = str(client.get_product_id_by_name(name))
         bz_product_ids.append(product_id)
-        print("Creating project [ %s ] with name [ %s ]" % (product_id, name))
-        try:
-            target.getProject(product_id)
-        except YouTrackException:
-            target.createProjectDetailed(
-                product_id,
-                name,
-                client.get_project_description(product_id),
-                'root'
-            )
-
-        print("Importing components for project [ %s ]" % product_id)
-        process_components(client.get_components(product_id), product_id, target)
-        print("Importing components finished for project [ %s ]" % product_id)
-
-        print("Importing versions for project [ %s ]" % product_id)
-        process_versions(client.get_versions(product_id), product_id, target)
-        print("Importing versions finished for project [ %s ] finished" % product_id)
+        if not journal.is_done('project:' + product_id):
+            print("Creating project [ %s ] with name [ %s ]" % (product_id, name))
+            try:
+                target.getProject(product_id)
+            except YouTrackException:
+                target.createProjectDetailed(
+                    product_id,
+                    name,
+                    client.get_project_description(product_id),
+                    'root'
+                )
+
+            print("Importing components for project [ %s ]" % product_id)
+            process_components(client.get_components(product_id), product_id, target)
+            print("Importing components finished for project [ %s ]" % product_id)
+
+            print("Importing versions for project [ %s ]" % product_id)
+            process_versions(client.get_versions(product_id), product_id, target)
+            print("Importing versions finished for project [ %s ] finished" % product_id)
+            journal.done('project:' + product_id)
 
         print("Importing issues to project [ %s ]" % product_id)
-        max_count = 100
-        count = 0
-        from_id = 0
-        bz_issues_count = client.get_issues_count(product_id)
-        while count < bz_issues_count:
-            batch = client.get_issues(product_id, from_id, from_id + max_count)
-            batch = [bz_issue for bz_issue in batch]
-            count += len(batch)
-            from_id += max_count
-            target.importIssues(product_id, product_id + " assignees",
-                [to_yt_issue(bz_issue, product_id, target) for bz_issue in batch])
-            # todo convert to good tags import
-            for issue in batch:
-                tags = issue["keywords"] | issue["flags"]
-                for t in tags:
-                    print("Processing tag [ %s ]" % t.encode('utf8'))
-                    target.executeCommand(str(product_id) + "-" + str(issue[get_number_in_project_field_name()]),
-                        "tag " + t.encode('utf8'))
-            for issue in batch:
-                issue_id = str(product_id) + '-' + \
-                           str(issue[get_number_in_project_field_name()])
-                for attach in issue["attachments"]:
-                    print("Processing attachment [ %s ] for issue %s" %
-                          (utf8encode(attach.name), issue_id))
-                    content = StringIO(attach.content)
-                    try:
-                        target.importAttachment(
-                            issue_id, attach.name, content, attach.reporter.login,
-                            None, None, str(int(attach.created) * 1000))
-                    except urllib2.HTTPError as e:
-                        print("WARN: Cant import attachment [ %s ]" %
-                              utf8encode(attach.name))
-                        print(e.code)
-                        print(e.read())
-                        print("Please check Max Upload File Size in YouTrack")
-                        continue
+        # Issues up to this id were imported by the interrupted run, only
+        # their attachments may be left
+        imported_id = int(journal.get_position(product_id, 0))
+        pipeline = Pipeline(read_issues(client, product_id, 100))
+        pipeline.add_stage('import', lambda batch: import_batch(
+            target, uploader, blob_client, journal, product_id, imported_id,
+            batch))
+        pipeline.run()
+        print(pipeline.summary())
         print("Importing issues to project [ %s ] finished" % product_id)
+    uploader.join()
 
     # todo add pagination to links
     print("Importing issue links")
@@ -549,9 +626,16 @@ def bugzilla2youtrack(params):
     for link in links:
         print("Processing link %s for issue%s" % (link.name, link.source))
         if (str(link.target_product_id) in bz_product_ids) and (str(link.source_product_id) in bz_product_ids):
-            links_to_import.append(to_yt_issue_link(link))
-    print(target.importLinks(links_to_import))
+            yt_link = to_yt_issue_link(link)
+            if not journal.has('link', link_key(yt_link)):
+                links_to_import.append(yt_link)
+    for i in range(0, len(links_to_import), 100):
+        chunk = links_to_import[i:i + 100]
+        print(target.importLinks(chunk))
+        journal.add_all('link', [link_key(yt_link) for yt_link in chunk])
     print("Importing issue links finished")
+    journal.close()
+    print(client.user_cache.summary())
 
 
 if __name__ == "__main__":
@@ -13,6 +13,8 @@ import calendar
 import time
 import json
 import datetime
+import multiprocessing
+from collections import deque
 from youtrackutils import csvClient
 import youtrackutils.csvClient.youtrackMapping
 from youtrackutils.csvClient.client import Client
@@ -20,6 +22,8 @@ from youtrack.youtrackImporter import *
 from youtrack import User, Comment, Link
 from youtrack.connection import Connection
 from youtrack.sync.links import LinkImporter
+from youtrackutils.utils.attachments import AttachmentUploader, \
+    DEFAULT_WORKERS
 
 
 csvClient.FIELD_TYPES.update(youtrack.EXISTING_FIELD_TYPES)
@@ -67,6 +71,13 @@ Options:
          Import comments from the file
     -a ATTACHMENTS_FILE,
          Import attachments from the file
+    -j WORKERS,
+         Number of attachments to upload in parallel (default %d)
+    -R RATE,
+         Max number of attachment uploads per second (not limited by default)
+    --workers N,
+         Number of processes parsing and converting csv rows (default 1).
+         The main process only sends converted issues to YouTrack
 
 Examples:
 
@@ -80,13 +91,14 @@ Examples:
     $ %s -T token -m mapping.json source.csv https://youtrack.company.com
 
 
-""" % (basename, help_url, basename, basename))
+""" % (basename, help_url, DEFAULT_WORKERS, basename, basename))
 
 
 def main():
     try:
         params = {}
-        opts, args = getopt.getopt(sys.argv[1:], 'hgu:p:m:c:a:t:T:')
+        opts, args = getopt.getopt(sys.argv[1:], 'hgu:p:m:c:a:t:T:j:R:',
+                                   ['workers='])
         for opt, val in opts:
             if opt == '-h':
                 usage()
@@ -107,6 +119,12 @@ def main():
                 params['token'] = val
             elif opt == '-T':
                 check_file_and_save(val, params, 'token_file')
+            elif opt == '-j':
+                params['attachment_workers'] = int(val)
+            elif opt == '-R':
+                params['attachment_rate'] = float(val)
+            elif opt == '--workers':
+                params['workers'] = int(val)
 
         if params.get('generate_mapping', False):
             params['issues_file'] = args[0]
@@ -241,38 +259,213 @@ def csv2youtrack(params):
 
         config = CsvYouTrackImportConfig(csvClient.FIELD_NAMES,
                                          csvClient.FIELD_TYPES)
-        importer = CsvYouTrackImporter(source, target, config)
+        uploader = AttachmentUploader(
+            params['target_url'],
+            workers=params.get('attachment_workers', DEFAULT_WORKERS),
+            rate=params.get('attachment_rate'))
+        importer = CsvYouTrackImporter(source, target, config, uploader,
+                                       params.get('workers', 1))
         importer.import_csv()
     else:
         print("Nothing to import.")
 
 
+_DATE_DIRECTIVES = ('Y', 'm', 'd', 'H', 'M', 'S')
+_EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+_date_parsers = dict([])
+
+
+def get_date_parser(format_string):
+    if format_string not in _date_parsers:
+        _date_parsers[format_string] = DateParser(format_string)
+    return _date_parsers[format_string]
+
+
+class DateParser(object):
+    """Converts dates in a strptime format to unix time in milliseconds.
+
+    Formats made of %Y, %m, %d, %H, %M, %S and text in between are matched
+    with a regular expression compiled once, and the time is computed
+    without strptime. Dates that don't match it (numbers without leading
+    zeros, out of range values) and other formats go through strptime.
+    An offset at the end of a %z format is ignored. Recent results are
+    cached, as exports often have many equal dates.
+    """
+
+    cache_size = 100000
+
+    def __init__(self, format_string):
+        self._strip_offset = format_string[-2:] == "%z"
+        if self._strip_offset:
+            format_string = format_string[:-2].rstrip()
+        self._format = format_string
+        self._regex, self._groups = self._compile(format_string)
+        self._cache = dict([])
+
+    @staticmethod
+    def _compile(format_string):
+        pattern = ''
+        groups = dict([])
+        for part in re.split(r'(%.)', format_string):
+            if part == '%%':
+                pattern += '%'
+            elif len(part) == 2 and part[0] == '%':
+                if part[1] not in _DATE_DIRECTIVES or part[1] in groups:
+                    return None, None
+                groups[part[1]] = len(groups)
+                pattern += r'(\d{4})' if part[1] == 'Y' else r'(\d\d)'
+            else:
+                # strptime matches whitespace in the format with any
+                # amount of it and ignores case
+                pattern += r'\s+'.join(
+                    [re.escape(p) for p in re.split(r'\s+', part)])
+        if not set(['Y', 'm', 'd']).issubset(groups):
+            return None, None
+        return (re.compile(pattern + r'\Z', re.IGNORECASE),
+                tuple([groups.get(d) for d in _DATE_DIRECTIVES]))
+
+    def to_unix_date(self, date):
+        result = self._cache.get(date)
+        if result is None:
+            if len(self._cache) >= self.cache_size:
+                self._cache.clear()
+            result = self._cache[date] = self._parse(date)
+        return result
+
+    def _parse(self, date):
+        if self._strip_offset:
+            date = date[:-6]
+        match = self._regex.match(date) if self._regex is not None else None
+        if match is not None:
+            values = match.groups()
+            year, month, day, hour, minute, second = [
+                int(values[i]) if i is not None else 0 for i in self._groups]
+            if hour < 24 and minute < 60 and second < 60:
+                try:
+                    days = datetime.date(year, month, day).toordinal() - \
+                        _EPOCH_ORDINAL
+                    return str(
+                        (days * 86400 + hour * 3600 + minute * 60 + second) *
+                        1000)
+                except ValueError:
+                    pass
+        dt = datetime.datetime.strptime(date, self._format)
+        return str(calendar.timegm(dt.timetuple()) * 1000)
+
+
 class CsvYouTrackImporter(YouTrackImporter):
-    def __init__(self, source, target, import_config):
+    batch_size = 100
+
+    def __init__(self, source, target, import_config, uploader, workers=1):
         super(CsvYouTrackImporter, self).__init__(source['issues'],
                                                   target,
                                                   import_config)
+        self._uploader = uploader
+        self._workers = workers
+        self._pool = None
         self._after = 0
-        self._comments = dict()
-        self._attachments = dict()
-        if 'comments' in source:
-            for c in source['comments'].get_rows():
-                issue_id = '%s-%s' % (c[0], c[1])
-                if issue_id not in self._comments:
-                    self._comments[issue_id] = []
-                self._comments[issue_id].append(c[2:])
-        if 'attachments' in source:
-            for a in source['attachments'].get_rows():
-                issue_id = '%s-%s' % (a[0], a[1])
-                if issue_id not in self._attachments:
-                    self._attachments[issue_id] = []
-                self._attachments[issue_id].append(a[2:])
+        # Rows of side files are found through an index on disk, the files
+        # may not fit in memory
+        self._comments = source.get('comments')
+        self._attachments = source.get('attachments')
+        for side_file in (self._comments, self._attachments):
+            if side_file is not None:
+                side_file.index_rows(lambda row: '%s-%s' % (row[0], row[1]))
         self._link_importer = LinkImporter(target)
 
     def import_csv(self, new_projects_owner_login=u'root'):
         projects = self._get_projects()
         self._source.reset()
-        self.do_import(projects, new_projects_owner_login)
+        if self._workers > 1:
+            self._pool = multiprocessing.Pool(
+                self._workers, _init_worker,
+                (self._source.get_file_path(), _get_csv_settings()))
+        try:
+            self.do_import(projects, new_projects_owner_login)
+        finally:
+            if self._pool is not None:
+                self._pool.terminate()
+                self._pool = None
+        self._uploader.join()
+
+    def _import_issues(self, project_id):
+        if self._pool is None:
+            return super(CsvYouTrackImporter, self)._import_issues(project_id)
+        fields = self._get_project_fields(project_id)
+        for batch in self._convert_issues(project_id, fields):
+            self._target.importIssues(
+                project_id, project_id + u' assignees',
+                [self._to_converted_yt_issue(project_id, issue, values)
+                 for issue, values in batch])
+            for issue, _ in batch:
+                yt_issue_id = u'%s-%s' % (project_id, self._get_issue_id(issue))
+                self._import_attachments(yt_issue_id,
+                                         self._get_attachments(issue))
+
+    def _get_project_fields(self, project_id):
+        """Returns YouTrack name and type of the field of every csv column.
+
+        process_field() asks the target for them for every value, with
+        workers this is done once per project and the result is passed
+        to the workers along with the rows.
+        """
+        fields = dict([])
+        for key in self._source.get_header() + [u'comments', u'markdown']:
+            field_name = self._get_field_name(key, project_id)
+            if field_name is None or field_name == NUMBER_IN_PROJECT:
+                continue
+            field_type = self._get_field_type(field_name)
+            if field_type is None and \
+                    field_name not in youtrack.EXISTING_FIELDS:
+                continue
+            fields[key] = (field_name, field_type)
+        return fields
+
+    def _convert_issues(self, project_id, fields):
+        """Yields batches of issues converted by workers in file order.
+
+        Only a few batches per worker are requested ahead, so converted
+        issues don't pile up in memory while the target is busy.
+        """
+        offsets = self._source.get_issue_offsets(project_id)
+        pending = deque()
+        for start in xrange(0, len(offsets), self.batch_size):
+            pending.append(self._pool.apply_async(
+                _convert_rows,
+                (offsets[start:start + self.batch_size].tolist(), fields)))
+            if len(pending) >= self._workers * 2:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+    def _to_converted_yt_issue(self, project_id, issue, values):
+        result = Issue()
+        result.comments = [self._to_yt_comment(comment)
+                           for comment in self._get_comments(issue)]
+        result.numberInProject = self._get_issue_id(issue)
+        for field_name, field_type, value in values:
+            if field_type is not None and field_type.startswith(u'user'):
+                # workers leave users as text, User objects can't be pickled
+                if isinstance(value, list):
+                    value = [self._to_yt_user(v) for v in value]
+                else:
+                    value = self._to_yt_user(value)
+            if isinstance(value, list):
+                for v in value:
+                    self._add_value_to_field(project_id, field_name,
+                                             field_type, v)
+            else:
+                self._add_value_to_field(project_id, field_name, field_type,
+                                         value)
+            if field_type is not None and field_type.startswith(u'user'):
+                if isinstance(value, list):
+                    value = [v.login for v in value]
+                else:
+                    value = value.login
+            if not isinstance(value, list):
+                value = str(value)
+            result[field_name] = value
+        return result
 
     def _to_yt_comment(self, comment):
         result = None
@@ -344,25 +537,25 @@ class CsvYouTrackImporter(YouTrackImporter):
         return '%s-%s' % (project_id, number_in_project)
 
     def _get_issues(self, project_id):
-        issues = self._source.get_issues()
+        issues = self._source.get_issues(project_id)
         if getattr(csvClient, 'USE_MARKDOWN', False):
             for issue in issues:
-                if self._import_config.get_project(issue)[0] == project_id:
-                    issue['markdown'] = "true"
-                    yield issue
+                issue['markdown'] = "true"
+                yield issue
         else:
             for issue in issues:
-                if self._import_config.get_project(issue)[0] == project_id:
-                    yield issue
+                yield issue
 
     def _get_comments(self, issue):
-        if self._comments:
-            return self._comments.get(self._get_yt_issue_id(issue), [])
+        if self._comments is not None:
+            return [c[2:] for c in
+                    self._comments.get_rows(self._get_yt_issue_id(issue))]
         return issue[self._import_config.get_key_for_field_name(u'comments')]
 
     def _get_attachments(self, issue):
-        if self._attachments:
-            return self._attachments.get(self._get_yt_issue_id(issue), [])
+        if self._attachments is not None:
+            return [a[2:] for a in
+                    self._attachments.get_rows(self._get_yt_issue_id(issue))]
         return []
 
     def _import_attachments(self, issue_id, issue_attachments):
@@ -371,10 +564,17 @@ class CsvYouTrackImporter(YouTrackImporter):
             self._import_user(yt_user)
             author = yt_user.login
             created = self._import_config.to_unix_date(attach[1])
-            name = os.path.basename(attach[2])
-            content = open(attach[2], 'rb')
-            self._target.importAttachment(
-                issue_id, name, content, author, None, None, created, '')
+            path = attach[2]
+            name = os.path.basename(path)
+
+            def upload(path=path, name=name, author=author, created=created):
+                with open(path, 'rb') as content:
+                    self._target.importAttachment(
+                        issue_id, name, content, author, None, None, created,
+                        '')
+
+            self._uploader.submit(issue_id, name, upload,
+                                  os.path.getsize(path))
 
     def _import_issue_links(self, project_ids):
         for project_id in project_ids:
@@ -431,11 +631,17 @@ class CsvYouTrackImporter(YouTrackImporter):
                 if (key not in [project_name_key, project_id_key])]
 
     def _get_projects(self):
+        # Rows of every project are indexed in the same pass, so that later
+        # passes over a project read only its rows
         result = {}
-        for issue in self._source.get_issues():
+
+        def get_project_id(issue):
             project_id, project_name = self._import_config.get_project(issue)
             if project_id not in result:
                 result[project_id] = project_name
+            return project_id
+
+        self._source.index_issues(get_project_id)
         return result
 
     def _get_custom_fields_for_projects(self, project_ids):
@@ -444,6 +650,68 @@ class CsvYouTrackImporter(YouTrackImporter):
         return [f for f in fields if f is not None]
 
 
+_CSV_SETTINGS = ('FIELD_NAMES', 'FIELD_TYPES', 'CSV_DELIMITER',
+                 'VALUE_DELIMITER', 'DATE_FORMAT_STRING', 'USE_MARKDOWN')
+_worker = None
+
+
+def _get_csv_settings():
+    return dict([(name, getattr(csvClient, name))
+                 for name in _CSV_SETTINGS if hasattr(csvClient, name)])
+
+
+def _init_worker(file_path, settings):
+    global _worker
+    for name, value in settings.items():
+        setattr(csvClient, name, value)
+    _worker = _RowConverter(Client(file_path))
+
+
+def _convert_rows(offsets, fields):
+    return _worker.convert(offsets, fields)
+
+
+def _is_empty(value):
+    return value is None or \
+        (isinstance(value, (list, basestring)) and not len(value))
+
+
+class _RowConverter(CsvYouTrackImporter):
+    """Parses and converts csv rows in a worker process.
+
+    Only the part of process_field() that doesn't talk to YouTrack is
+    done here: users, bundle values and issues are created by the main
+    process.
+    """
+
+    def __init__(self, source):
+        YouTrackImporter.__init__(
+            self, source, None,
+            CsvYouTrackImportConfig(csvClient.FIELD_NAMES,
+                                    csvClient.FIELD_TYPES))
+
+    def _to_yt_user(self, value):
+        return value
+
+    def convert(self, offsets, fields):
+        """Returns (issue, [(field name, field type, value)]) for the rows."""
+        result = []
+        use_markdown = getattr(csvClient, 'USE_MARKDOWN', False)
+        for issue in self._source.get_issues_at(offsets):
+            if use_markdown:
+                issue['markdown'] = "true"
+            values = []
+            for key, value in issue.items():
+                if key not in fields or _is_empty(value):
+                    continue
+                field_name, field_type = fields[key]
+                values.append((field_name, field_type,
+                               self.get_field_value(field_name, field_type,
+                                                    value)))
+            result.append((issue, values))
+        return result
+
+
 class CsvYouTrackImportConfig(YouTrackImportConfig):
     def __init__(self, name_mapping, type_mapping, value_mapping=None):
         super(CsvYouTrackImportConfig, self).__init__(name_mapping,
@@ -452,14 +720,7 @@ class CsvYouTrackImportConfig(YouTrackImportConfig):
 
     @staticmethod
     def to_unix_date(date):
-        if csvClient.DATE_FORMAT_STRING[-2:] == "%z":
-            dt = datetime.datetime.strptime(
-                date[:-6],
-                csvClient.DATE_FORMAT_STRING[:-2].rstrip())
-        else:
-            dt = datetime.datetime.strptime(
-                date, csvClient.DATE_FORMAT_STRING)
-        return str(calendar.timegm(dt.timetuple()) * 1000)
+        return get_date_parser(csvClient.DATE_FORMAT_STRING).to_unix_date(date)
 
     @staticmethod
     def get_project_id_key():
@@ -2,6 +2,8 @@ import codecs
 import os
 import sys
 import csv
+import sqlite3
+from array import array
 from youtrackutils import csvClient
 
 maxInt = sys.maxint
@@ -15,11 +17,19 @@ while True:
         maxInt = int(maxInt/10)
 
 
+def _to_blob(value):
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return sqlite3.Binary(value)
+
+
 class Client(object):
     def __init__(self, file_path):
         self._file_path = file_path
         self._header = self._read_header()
         self._issues_reader = None
+        self._offsets = None
+        self._row_index = None
 
     def _read_header(self):
         header = self._get_reader().next()
@@ -32,37 +42,154 @@ class Client(object):
         raw = open(self._file_path, 'rb').read(b_cnt)
         return raw.startswith(codecs.BOM_UTF8)
 
-    def _get_reader(self):
+    def _open(self):
         fh = open(self._file_path, "rU")
         if self.has_bom():
             fh.read(len(codecs.BOM_UTF8))
-        return csv.reader(fh, delimiter=csvClient.CSV_DELIMITER)
+        return fh
+
+    def _get_reader(self, fh=None):
+        if fh is None:
+            fh = self._open()
+        # readline() keeps fh.tell() accurate, unlike iterating the file
+        return csv.reader(iter(fh.readline, ''),
+                          delimiter=csvClient.CSV_DELIMITER)
 
-    def get_rows(self):
+    def get_rows(self, key=None):
+        """Yields all rows or, after index_rows(), rows of the key."""
+        if key is not None:
+            for row in self._get_indexed_rows(key):
+                yield row
+            return
         reader = self._get_reader()
         for row in reader:
             yield row
 
-    def get_issues(self):
+    def index_rows(self, get_key, batch_size=10000):
+        """Reads the file once and remembers where rows of every key are.
+
+        Unlike index_issues() the offsets are kept in a temporary SQLite
+        file, so memory use doesn't depend on the size of the file.
+        """
+        db = sqlite3.connect('')
+        db.executescript("""
+            PRAGMA synchronous = OFF;
+            PRAGMA journal_mode = OFF;
+            CREATE TABLE row (key BLOB, offset INTEGER);
+        """)
+        fh = self._open()
+        reader = self._get_reader(fh)
+        batch = []
+        while True:
+            offset = fh.tell()
+            try:
+                row = reader.next()
+            except StopIteration:
+                break
+            if not row:
+                continue
+            batch.append((_to_blob(get_key(row)), offset))
+            if len(batch) >= batch_size:
+                with db:
+                    db.executemany("INSERT INTO row VALUES (?, ?)", batch)
+                batch = []
+        with db:
+            db.executemany("INSERT INTO row VALUES (?, ?)", batch)
+            db.execute("CREATE INDEX row_key ON row (key, offset)")
+        fh.close()
+        self._row_index = db
+
+    def _get_indexed_rows(self, key):
+        if self._row_index is None:
+            raise RuntimeError("index_rows() has to be called first")
+        offsets = [r[0] for r in self._row_index.execute(
+            "SELECT offset FROM row WHERE key = ? ORDER BY offset",
+            (_to_blob(key),))]
+        if not offsets:
+            return
+        fh = self._open()
+        try:
+            for offset in offsets:
+                fh.seek(offset)
+                yield self._get_reader(fh).next()
+        finally:
+            fh.close()
+
+    def get_issues(self, key=None):
+        """Yields all issues or, after index_issues(), issues of the key."""
+        if key is not None:
+            for issue in self._get_indexed_issues(key):
+                yield issue
+            return
         reader = self._get_reader()
         reader.next()
-        header_len = len(self._header)
         for row in reader:
+            if row:
+                yield self._to_issue(row)
+
+    def index_issues(self, get_key):
+        """Reads the file once and remembers where rows of every key are.
+
+        get_key is called for every issue, afterwards get_issues(key) only
+        reads and parses rows of the key.
+        """
+        offsets = dict([])
+        fh = self._open()
+        reader = self._get_reader(fh)
+        reader.next()
+        while True:
+            offset = fh.tell()
+            try:
+                row = reader.next()
+            except StopIteration:
+                break
             if not row:
                 continue
-            issue = {"comments": []}
-            for i in range(len(row)):
-                value = row[i].strip()
-                if len(value):
-                    if i < header_len:
-                        issue[self._header[i]] = value
-                    else:
-                        issue["comments"].append(value)
+            key = get_key(self._to_issue(row))
+            if key not in offsets:
+                offsets[key] = array('l')
+            offsets[key].append(offset)
+        fh.close()
+        self._offsets = offsets
+
+    def _get_indexed_issues(self, key):
+        for issue in self.get_issues_at(self.get_issue_offsets(key)):
             yield issue
 
+    def get_issue_offsets(self, key):
+        """Returns offsets of rows of the key found by index_issues()."""
+        if self._offsets is None:
+            raise RuntimeError("index_issues() has to be called first")
+        return self._offsets.get(key, array('l'))
+
+    def get_issues_at(self, offsets):
+        """Yields issues of the rows at the offsets."""
+        fh = self._open()
+        try:
+            for offset in offsets:
+                fh.seek(offset)
+                yield self._to_issue(self._get_reader(fh).next())
+        finally:
+            fh.close()
+
+    def _to_issue(self, row):
+        header_len = len(self._header)
+        issue = {"comments": []}
+        for i in range(len(row)):
+            value = row[i].strip()
+            if len(value):
+                if i < header_len:
+                    issue[self._header[i]] = value
+                else:
+                    issue["comments"].append(value)
+        return issue
+
     def get_header(self):
         return self._header
 
+    def get_file_path(self):
+        return self._file_path
+
     def reset(self):
         self._issues_reader = self._get_reader()
         self._read_header()
@@ -16,6 +16,9 @@ import youtrackutils.fbugz
 import youtrackutils.fbugz.defaultFBugz
 from youtrack.importHelper import *
 from utils.mapfile import load_map_file, dump_map_file
+from utils.attachments import AttachmentUploader, DEFAULT_WORKERS, \
+    import_from_attachment
+from utils.pipeline import Pipeline
 
 
 help_url = "\
@@ -63,6 +66,10 @@ Options:
          Path to mapping file that maps columns from csv to YouTrack fields
     -d PROJECT_LEAD_LOGIN
          YouTrack user to set as project lead for imported projects
+    -j WORKERS,
+         Number of attachments to upload in parallel (default %d)
+    -R RATE,
+         Max number of attachment uploads per second (not limited by default)
 
 Examples:
 
@@ -77,13 +84,13 @@ Examples:
     https://fogbugz.company.com fb fb 1000
 
 
-""" % (basename, help_url, basename, basename))
+""" % (basename, help_url, DEFAULT_WORKERS, basename, basename))
 
 
 def main():
     try:
         params = {}
-        opts, args = getopt.getopt(sys.argv[1:], 'hgu:p:m:t:T:d:')
+        opts, args = getopt.getopt(sys.argv[1:], 'hgu:p:m:t:T:d:j:R:')
         for opt, val in opts:
             if opt == '-h':
                 usage()
@@ -102,7 +109,11 @@ def main():
                 check_file_and_save(val, params, 'token_file')
             elif opt == '-d':
                 params['project_lead_login'] = val
-    except getopt.GetoptError as e:
+            elif opt == '-j':
+                params['attachment_workers'] = int(val)
+            elif opt == '-R':
+                params['attachment_rate'] = float(val)
+    except (getopt.GetoptError, ValueError) as e:
         print(e)
         usage()
         sys.exit(1)
@@ -273,6 +284,51 @@ def to_yt_field_value(field_name, value):
     return youtrackutils.fbugz.CF_VALUES[field_name][value]
 
 
+def read_issues(source, project_name, max_issue_id, max_count):
+    # FogBugz is only queried from here, parent issue projects are looked up
+    # along with the issues
+    start = 0
+    while start <= max_issue_id:
+        fb_issues = source.get_issues(project_name, start, max_count)
+        parent_projects = dict([])
+        for issue in fb_issues:
+            if issue.bug_parent is not None and \
+                    issue.bug_parent not in parent_projects:
+                parent_projects[issue.bug_parent] = \
+                    source.get_issue_project_id(issue.bug_parent)
+        yield fb_issues, parent_projects
+        start += max_count
+
+
+def import_issues(target, uploader, project_id, project_name, value_sets,
+                  links_to_import, fb_issues, parent_projects):
+    issues_to_import = []
+    for issue in fb_issues :
+        add_values_to_field(target, get_yt_field_name('area'), project_id,
+                            [issue.field_values['area']], lambda bundle, value: bundle.createElement(value))
+        issues_to_import.append(_to_yt_issue(issue, value_sets))
+    target.importIssues(project_id, project_name.encode('utf-8') + " assignees", issues_to_import)
+    for issue in fb_issues :
+        full_issue_id = '%s-%s' % (project_id, issue.ix_bug)
+        for attach in issue.attachments :
+            # Otherwise the issue would be requested from the upload
+            # thread to get the creation time
+            attach.created = issue.opened
+            uploader.submit(
+                full_issue_id, attach.name,
+                lambda issue_id=full_issue_id, attach=attach:
+                import_from_attachment(target, issue_id, attach))
+        for tag in issue.tags :
+            target.executeCommand(full_issue_id, 'tag ' + tag)
+        if issue.bug_parent is not None:
+            parent_issue_id = '%s-%s' % (parent_projects[issue.bug_parent], issue.bug_parent)
+            link = Link()
+            link.typeName = 'parent-child'
+            link.source = full_issue_id
+            link.target = parent_issue_id
+            links_to_import.append(link)
+
+
 def fb2youtrack(params):
     # Connection to FogBugz
     source = FBClient(params['fb_url'],
@@ -310,6 +366,10 @@ def fb2youtrack(params):
         params['project_lead_login'] = project_lead
 
     max_issue_id = params['fb_max_issue_id']
+    uploader = AttachmentUploader(
+        params['yt_url'],
+        workers=params.get('attachment_workers', DEFAULT_WORKERS),
+        rate=params.get('attachment_rate'))
 
     project_names = youtrackutils.fbugz.PROJECTS_TO_IMPORT
     accessible_projects = source.list_project_names()
@@ -441,33 +501,15 @@ def fb2youtrack(params):
                             lambda bundle, value: _to_yt_subsystem(bundle, value))
 
         print('Importing issues for project [ %s ]' % project_name)
-        start = 0
-        issues_to_import = []
-        # create dictionary with child : parent pairs
-        while start <= max_issue_id:
-            fb_issues = source.get_issues(project_name, start, 30)
-            for issue in fb_issues :
-                add_values_to_field(target, get_yt_field_name('area'), project_id,
-                                    [issue.field_values['area']], lambda bundle, value: bundle.createElement(value))
-                issues_to_import.append(_to_yt_issue(issue, value_sets))
-            target.importIssues(project_id, project_name.encode('utf-8') + " assignees", issues_to_import)
-            for issue in fb_issues :
-                full_issue_id = '%s-%s' % (project_id, issue.ix_bug)
-                for attach in issue.attachments :
-                    target.createAttachmentFromAttachment(full_issue_id, attach)
-                for tag in issue.tags :
-                    target.executeCommand(full_issue_id, 'tag ' + tag)
-                if issue.bug_parent is not None:
-                    parent_issue_id = '%s-%s' % (source.get_issue_project_id(issue.bug_parent), issue.bug_parent)
-                    link = Link()
-                    link.typeName = 'parent-child'
-                    link.source = full_issue_id
-                    link.target = parent_issue_id
-                    links_to_import.append(link)
-            issues_to_import = []
-            start += 30
+        pipeline = Pipeline(read_issues(source, project_name, max_issue_id, 30))
+        pipeline.add_stage('import', lambda batch: import_issues(
+            target, uploader, project_id, project_name, value_sets,
+            links_to_import, *batch))
+        pipeline.run()
+        print(pipeline.summary())
         print('Importing issues for project [ %s ] finished' % project_name)
 
+    uploader.join()
     print('Importing issue links')
     print(target.importLinks(links_to_import))
     print('Importing issue links finished')
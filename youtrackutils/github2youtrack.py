@@ -8,11 +8,18 @@ if sys.version_info >= (3, 0):
 
 import os
 import re
+import json
+import time
+import threading
 import requests
 import csv
+from multiprocessing.pool import ThreadPool
+from requests.adapters import HTTPAdapter
+from requests.utils import parse_header_links
 import youtrackutils.csvClient
 import csv2youtrack
 from youtrack.importHelper import utf8encode
+from youtrackutils.utils.httpcache import ResponseCache
 
 youtrackutils.csvClient.FIELD_NAMES = {
     "Project Name" : "project_name",
@@ -43,6 +50,9 @@ youtrackutils.csvClient.VALUE_DELIMITER = "|"
 youtrackutils.csvClient.USE_MARKDOWN = True
 
 CSV_FILE = "github2youtrack-{repo}-{data}.csv"
+CACHE_FILE = "github2youtrack-{repo}.cache"
+DEFAULT_WORKERS = 4
+PER_PAGE = 100
 
 help_url = "\
 https://www.jetbrains.com/help/youtrack/standalone/import-from-github.html"
@@ -76,19 +86,25 @@ Options:
          YouTrack user login to perform import on behalf of
     -p PASSWORD,
          YouTrack user password
+    -j WORKERS,
+         Number of GitHub requests to run in parallel (default %d)
+    -c CACHE_FILE,
+         File to cache GitHub responses in, so that a next run only asks
+         GitHub what has changed (default %s)
 
 Examples:
 
     $ %s -T token https://youtrack.company.com gh-user gh-pass test-repo
 
 
-""" % (basename, help_url, basename))
+""" % (basename, help_url, DEFAULT_WORKERS,
+       CACHE_FILE.format(repo='<gh_repo>'), basename))
 
 
 def main():
     try:
         params = {}
-        opts, args = getopt.getopt(sys.argv[1:], 'hu:p:t:T:')
+        opts, args = getopt.getopt(sys.argv[1:], 'hu:p:t:T:j:c:')
         for opt, val in opts:
             if opt == '-h':
                 usage()
@@ -101,10 +117,18 @@ def main():
                 params['token'] = val
             elif opt == '-T':
                 check_file_and_save(val, params, 'token_file')
+            elif opt == '-j':
+                params['github_workers'] = int(val)
+            elif opt == '-c':
+                check_file_and_save(val, params, 'cache_file')
     except getopt.GetoptError as e:
         print(e)
         usage()
         sys.exit(1)
+    except ValueError:
+        print("Bad arguments")
+        usage()
+        sys.exit(1)
 
     try:
         params['target_url'], github_user, github_password, github_repo = args
@@ -126,7 +150,9 @@ def main():
                github_user,
                github_password,
                github_repo,
-               github_repo_owner)
+               github_repo_owner,
+               params.get('github_workers', DEFAULT_WORKERS),
+               params.get('cache_file', CACHE_FILE.format(repo=github_repo)))
 
     csv2youtrack.csv2youtrack(params)
 
@@ -144,12 +170,123 @@ def get_last_part_of_url(url_string):
     return url_string.split('/').pop()
 
 
+def get_next_url(link):
+    """Returns the rel="next" url of a Link header or None."""
+    for l in parse_header_links(link or ''):
+        if l.get('rel') == 'next':
+            return l['url']
+    return None
+
+
+class GitHubClient(object):
+    """Reads GitHub API resources through one pooled session.
+
+    Responses are stored in the cache and requests for cached urls are
+    conditional, so unchanged resources are answered with 304, which
+    GitHub doesn't count against the rate limit. When the limit is about
+    to run out, requests wait for its reset instead of failing. The client
+    can be shared by `workers` threads.
+    """
+
+    def __init__(self, auth, cache=None, workers=DEFAULT_WORKERS):
+        self._session = requests.Session()
+        self._session.auth = auth
+        # comment workers and the thread reading issue pages run at once
+        self._session.mount('https://', HTTPAdapter(
+            pool_connections=1, pool_maxsize=max(1, workers) + 1))
+        self._cache = cache
+        self._min_remaining = max(1, workers)
+        self._resume_at = 0
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.not_modified = 0
+
+    def get_pages(self, url):
+        """Yields pages of the url following rel="next" Link headers."""
+        while url:
+            page, link = self._get(url)
+            yield page
+            url = get_next_url(link)
+
+    def get_all(self, url):
+        """Returns items of all pages of the url."""
+        items = []
+        for page in self.get_pages(url):
+            items.extend(page)
+        return items
+
+    def summary(self):
+        return "GitHub: %d requests, %d not modified" % (
+            self.requests, self.not_modified)
+
+    def close(self):
+        self._session.close()
+
+    def _get(self, url):
+        cached = self._cache.get(url) if self._cache is not None else None
+        headers = dict([])
+        if cached is not None:
+            etag, last_modified = cached[:2]
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+        while True:
+            delay = self._resume_at - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            response = self._session.get(url, headers=headers)
+            with self._lock:
+                self.requests += 1
+            if not self._throttle(response):
+                break
+        if response.status_code == 304 and cached is not None:
+            with self._lock:
+                self.not_modified += 1
+            return json.loads(cached[3]), cached[2]
+        if response.status_code != 200:
+            raise Exception("GitHub request [ %s ] failed: %d %s" % (
+                url, response.status_code, response.reason))
+        link = response.headers.get('Link')
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if self._cache is not None and (etag or last_modified):
+            self._cache.put(url, etag, last_modified, link, response.content)
+        return response.json(), link
+
+    def _throttle(self, response):
+        """Makes requests wait for the rate limit reset if it's about to
+        run out. Returns True if the limit refused the request, then it
+        has to be repeated.
+        """
+        headers = response.headers
+        now = time.time()
+        resume_at = None
+        if headers.get('Retry-After', '').isdigit():
+            resume_at = now + int(headers['Retry-After'])
+        elif headers.get('X-RateLimit-Remaining', '').isdigit() and \
+                headers.get('X-RateLimit-Reset', '').isdigit() and \
+                int(headers['X-RateLimit-Remaining']) < self._min_remaining:
+            resume_at = max(now, int(headers['X-RateLimit-Reset'])) + 1
+        if resume_at is None:
+            return False
+        with self._lock:
+            if resume_at > self._resume_at:
+                self._resume_at = resume_at
+                print("GitHub rate limit is reached, waiting %d s" %
+                      (resume_at - now))
+        return response.status_code in (403, 429)
+
+
+def get_comment_urls(issues):
+    return [issue['comments_url'] for issue in issues
+            if int(issue.get('comments', 0)) > 0 and 'comments_url' in issue]
+
+
 # based on https://gist.github.com/unbracketed/3380407
-def write_issues(r, issues_csvout, comments_csvout, repo, auth):
-    """output a list of issues to csv"""
-    if not r.status_code == 200:
-        raise Exception(r.status_code)
-    for issue in r.json():
+def write_issues(issues, comments, issues_csvout, comments_csvout, repo):
+    """output a list of issues and their comments (by comments_url) to csv"""
+    for issue in issues:
         labels = []
         labels_lowercase = []
         for label in issue['labels']:
@@ -201,11 +338,8 @@ def write_issues(r, issues_csvout, comments_csvout, repo, auth):
                      issue_type, milestone]
         issues_csvout.writerow([utf8encode(e) for e in issue_row])
         
-        if int(issue.get('comments', 0)) > 0 and 'comments_url' in issue:
-            rc = requests.get(issue['comments_url'], auth=auth)
-            if not rc.status_code == 200:
-                raise Exception(r.status_code)
-            for comment in rc.json():
+        if issue.get('comments_url') in comments:
+            for comment in comments[issue['comments_url']]:
                 author = comment['user'].get('login')
                 if not author:
                     author = get_last_part_of_url(comment['user'].get(u'url'))
@@ -214,11 +348,12 @@ def write_issues(r, issues_csvout, comments_csvout, repo, auth):
                 comments_csvout.writerow([utf8encode(e) for e in comment_row])
 
 
-def github2csv(issues_csv_file, comments_csv_file, github_user, github_password, github_repo, github_repo_owner):
-    issues_url = 'https://api.github.com/repos/%s/%s/issues?state=all' % (github_repo_owner, github_repo)
+def github2csv(issues_csv_file, comments_csv_file, github_user, github_password, github_repo, github_repo_owner,
+               workers=DEFAULT_WORKERS, cache_file=None):
+    issues_url = 'https://api.github.com/repos/%s/%s/issues?state=all&per_page=%d' % (
+        github_repo_owner, github_repo, PER_PAGE)
     AUTH = (github_user, github_password)
 
-    r = requests.get(issues_url, auth=AUTH)
     issues_csvout = csv.writer(open(issues_csv_file, 'wb'))
     issues_csvout.writerow(
         ('Project Name', 'Project Id', 'Id', 'State', 'Summary', 'Description',
@@ -227,21 +362,35 @@ def github2csv(issues_csv_file, comments_csv_file, github_user, github_password,
     comments_csvout = csv.writer(open(comments_csv_file, 'wb'))
     comments_csvout.writerow(
         ('Project Id', 'Id', 'Author', 'Created', 'Text'))
-    write_issues(r, issues_csvout, comments_csvout, github_repo, AUTH)
-
-    #more pages? examine the 'link' header returned
-    if 'link' in r.headers:
-        pages = dict(
-            [(rel[6:-1], url[url.index('<')+1:-1]) for url, rel in
-                [link.split(';') for link in
-                    r.headers['link'].split(',')]])
-        while 'last' in pages and 'next' in pages:
-            r = requests.get(pages['next'], auth=AUTH)
-            write_issues(r, issues_csvout, comments_csvout, github_repo, AUTH)
-            pages = dict(
-                [(rel[6:-1], url[url.index('<') + 1:-1]) for url, rel in
-                 [link.split(';') for link in
-                  r.headers['link'].split(',')]])
+
+    cache = ResponseCache(cache_file) if cache_file else None
+    client = GitHubClient(AUTH, cache, workers)
+    pool = ThreadPool(max(1, workers))
+
+    def get_comments(url):
+        return client.get_all(url + '?per_page=%d' % PER_PAGE)
+
+    def write_page(issues, urls, comments):
+        write_issues(issues, dict(zip(urls, comments.get())),
+                     issues_csvout, comments_csvout, github_repo)
+
+    try:
+        # comments of a page are fetched while the next page is read
+        previous = None
+        for issues in client.get_pages(issues_url):
+            urls = get_comment_urls(issues)
+            current = (issues, urls, pool.map_async(get_comments, urls))
+            if previous is not None:
+                write_page(*previous)
+            previous = current
+        if previous is not None:
+            write_page(*previous)
+        print(client.summary())
+    finally:
+        pool.close()
+        client.close()
+        if cache is not None:
+            cache.close()
 
 
 if __name__ == "__main__":
@@ -1,6 +1,7 @@
 import MySQLdb
 import MySQLdb.cursors
 from youtrackutils.mantis import *
+from youtrackutils.utils.usercache import UserCache
 
 
 class MantisClient(object):
@@ -8,6 +9,7 @@ class MantisClient(object):
         self.batch_subprojects = batch_subprojects
         self.sql_cnx = MySQLdb.connect(host=host, port=port, user=login, passwd=password,
             db=db_name, cursorclass=MySQLdb.cursors.DictCursor, charset=charset_name)
+        self.user_cache = UserCache(self._load_users, self._load_user)
 
 
     def get_project_id_by_name(self, project_name):
@@ -108,7 +110,7 @@ class MantisClient(object):
         return result
 
 
-    def get_mantis_issues(self, project_id, after, max):
+    def get_mantis_issues(self, project_id, after_id, max):
         cursor = self.sql_cnx.cursor()
         project_ids = (repr(self._calculate_project_ids(project_id)).replace('[', '(').replace(']', ')'))
         id_row = "id"
@@ -125,31 +127,49 @@ class MantisClient(object):
                             category_id_row, date_submitted_row, due_date_row, last_updated_row, "priority", "severity",
                             "reproducibility", "status", "resolution", "os_build", "os", "platform", "version",
                             "fixed_in_version", "build", "target_version"]
-
-
-
-        request = "SELECT %s FROM mantis_bug_table WHERE project_id IN %s LIMIT %d OFFSET %d" % (
-            ", ".join(rows_to_retrieve), project_ids, max, after)
+        joined_rows = ["t.description AS _description", "t.steps_to_reproduce AS _steps_to_reproduce",
+                       "t.additional_information AS _additional_information",
+                       "c.name AS _category_name", "p.name AS _project_name"]
+
+        # Text, category and project are joined into the page query and paging
+        # is done by id, so deep pages cost the same as the first one
+        request = "SELECT %s, %s FROM mantis_bug_table b " % (
+            ", ".join(["b." + r for r in rows_to_retrieve]), ", ".join(joined_rows))
+        request += "LEFT JOIN mantis_bug_text_table t ON t.id = b.bug_text_id "
+        request += "LEFT JOIN mantis_category_table c ON c.id = b.category_id "
+        request += "LEFT JOIN mantis_project_table p ON p.id = b.project_id "
+        request += "WHERE b.project_id IN %s AND b.id > %d ORDER BY b.id LIMIT %d" % (
+            project_ids, int(after_id), max)
         cursor.execute(request)
+        rows = list(cursor)
+        if not len(rows):
+            return []
+
+        ids = [row[id_row] for row in rows]
+        cf_values = self._get_cf_values_by_ids(ids)
+        comments = self._get_comments_by_ids(ids)
         result = []
-        for row in cursor:
-            row[id_row] = str(row[id_row])
+        for row in rows:
+            bug_id = row[id_row]
+            row[id_row] = str(bug_id)
             row[reporter_id_row] = self.get_user_by_id(row[reporter_id_row])
             row[handler_id_row] = self.get_user_by_id(row[handler_id_row])
 
-            row.update(self._get_text_fields(row[bug_text_id_row]))
+            row["description"] = self._to_description(row.pop("_description"),
+                                                      row.pop("_steps_to_reproduce"),
+                                                      row.pop("_additional_information"))
             row[bug_text_id_row] = None
 
-            row[project_id_row] = self._get_project_name_by_id(row[project_id_row])
-            row[category_id_row] = self._get_category_by_id(row[category_id_row])
+            row[project_id_row] = row.pop("_project_name")
+            row[category_id_row] = row.pop("_category_name")
 
             row[date_submitted_row] = self._to_epoch_time(row[date_submitted_row])
             row[due_date_row] = self._to_epoch_time(row[due_date_row])
             row[last_updated_row] = self._to_epoch_time(row[last_updated_row])
 
-            row.update(self._get_cf_values(row[id_row]))
+            row.update(cf_values.get(bug_id, {}))
 
-            row["comments"] = self._get_comments_by_id(row[id_row])
+            row["comments"] = comments.get(bug_id, [])
 
             result.append(row)
         return result
@@ -165,26 +185,28 @@ class MantisClient(object):
             result.append(row[name_row])
         return result
 
-    def _get_cf_values(self, bug_id):
+    def _get_cf_values_by_ids(self, bug_ids):
         result = {}
         cf_cursor = self.sql_cnx.cursor()
-        cf_cursor.execute("SELECT field_id, value FROM mantis_custom_field_string_table WHERE bug_id=%s",
-            (bug_id,))
+        request = "SELECT s.bug_id, s.value, f.name, f.type FROM mantis_custom_field_string_table s "
+        request += "JOIN mantis_custom_field_table f ON f.id = s.field_id "
+        request += "WHERE s.bug_id IN (%s)" % self._to_sql_list(bug_ids)
+        cf_cursor.execute(request)
         for row in cf_cursor:
-            issue_cf = self._get_cf_name_by_id(row["field_id"])
+            bug_values = result.setdefault(row["bug_id"], {})
             value = row["value"]
-            cf_name = issue_cf["name"]
-            if issue_cf["type"] in [3, 6, 7, 9, 5]:
+            cf_name = row["name"]
+            if row["type"] in [3, 6, 7, 9, 5]:
                 values = value.split("|")
-                result[cf_name] = []
+                bug_values[cf_name] = []
                 for v in values:
                     v = v.strip()
                     if v != "":
-                        result[cf_name].append(v)
-            elif issue_cf["type"] == 8:
-                result[cf_name] = self._to_epoch_time(value) if len(value) else ""
+                        bug_values[cf_name].append(v)
+            elif row["type"] == 8:
+                bug_values[cf_name] = self._to_epoch_time(value) if len(value) else ""
             else:
-                result[cf_name] = value
+                bug_values[cf_name] = value
         return result
 
     def get_issue_links(self, after, max):
@@ -245,12 +267,21 @@ class MantisClient(object):
 
     def get_user_by_id(self, id):
         if id:
-            cursor = self.sql_cnx.cursor()
-            request = "SELECT * FROM mantis_user_table WHERE id=%s LIMIT 1" %  str(id)
-            cursor.execute(request)
-            element = cursor.fetchone()
-            if element is not None:
-                return self._to_user(element)
+            return self.user_cache.get(id)
+        return None
+
+    def _load_users(self):
+        cursor = self.sql_cnx.cursor()
+        cursor.execute("SELECT * FROM mantis_user_table")
+        return [(row["id"], self._to_user(row)) for row in cursor]
+
+    def _load_user(self, id):
+        cursor = self.sql_cnx.cursor()
+        request = "SELECT * FROM mantis_user_table WHERE id=%s LIMIT 1" %  str(id)
+        cursor.execute(request)
+        element = cursor.fetchone()
+        if element is not None:
+            return self._to_user(element)
         return None
 
     def _calculate_project_ids(self, project_id):
@@ -275,52 +306,38 @@ class MantisClient(object):
         return result
 
 
-    def _get_text_fields(self, text_id):
-        cursor = self.sql_cnx.cursor()
-        description_row = "description"
-        steps_row = "steps_to_reproduce"
-        additional_row = "additional_information"
-        request = "SELECT %s, %s, %s " % (description_row, steps_row, additional_row)
-        request += "FROM mantis_bug_text_table WHERE id=%s LIMIT 1" % str(text_id)
-        cursor.execute(request)
-        row = cursor.fetchone()
-        description = row[description_row]
-        if (row[steps_row] is not None) and len(row[steps_row]):
-            description += "\n Steps to reproduce : \n" + row[steps_row]
-        if (row[additional_row] is not None) and len(row[additional_row]):
-            description += "\n Steps to reproduce : \n" + row[additional_row]
-        return {"description" : description}
-
-    def _get_category_by_id(self, id):
-        cursor = self.sql_cnx.cursor()
-        name_row = "name"
-        request = "SELECT %s FROM mantis_category_table WHERE id=%s LIMIT 1" % (name_row, str(id))
-        cursor.execute(request)
-        category = cursor.fetchone()
-        if category is None:
-            return None
-        else:
-            return category[name_row]
+    def _to_description(self, description, steps, additional):
+        if (steps is not None) and len(steps):
+            description += "\n Steps to reproduce : \n" + steps
+        if (additional is not None) and len(additional):
+            description += "\n Steps to reproduce : \n" + additional
+        return description
 
-    def _get_comments_by_id(self, id):
+    def _get_comments_by_ids(self, ids):
         cursor = self.sql_cnx.cursor()
         reporter_id_row = "reporter_id"
         bugnote_row = "bugnote_text_id"
         date_submitted_row = "date_submitted"
-        request = "SELECT %s, %s, %s" % (reporter_id_row, bugnote_row, date_submitted_row)
-        request += " FROM mantis_bugnote_table WHERE bug_id=%s" % str(id)
+        request = "SELECT bug_id, %s, %s, %s" % (reporter_id_row, bugnote_row, date_submitted_row)
+        request += " FROM mantis_bugnote_table WHERE bug_id IN (%s)" % self._to_sql_list(ids)
         cursor.execute(request)
-        result = []
-        for row in cursor:
-            text_cursor = self.sql_cnx.cursor()
+        notes = list(cursor)
+        texts = {}
+        if len(notes):
             note_row = "note"
-            req = "SELECT %s FROM mantis_bugnote_text_table WHERE id=%s LIMIT 1" % (note_row, str(row[bugnote_row]))
+            text_cursor = self.sql_cnx.cursor()
+            req = "SELECT id, %s FROM mantis_bugnote_text_table WHERE id IN (%s)" % (
+                note_row, self._to_sql_list(set([row[bugnote_row] for row in notes])))
             text_cursor.execute(req)
+            for row in text_cursor:
+                texts[row["id"]] = row[note_row]
+        result = {}
+        for row in notes:
             comment = MantisComment()
             comment.reporter = self.get_user_by_id(row[reporter_id_row])
             comment.date_submitted = self._to_epoch_time(row[date_submitted_row])
-            comment.text = text_cursor.fetchone()[note_row]
-            result.append(comment)
+            comment.text = texts[row[bugnote_row]]
+            result.setdefault(row["bug_id"], []).append(comment)
         return result
 
     def _get_project_id_by_bug_id(self, bug_id):
@@ -331,25 +348,21 @@ class MantisClient(object):
         return cursor.fetchone()[project_id_row]
 
 
-    def _get_cf_name_by_id(self, id):
-        cursor = self.sql_cnx.cursor()
-        cursor.execute("SELECT name, type  FROM mantis_custom_field_table WHERE id=%s LIMIT 1", (str(id),))
-        return cursor.fetchone()
-
-    def _get_project_name_by_id(self, id):
-        cursor = self.sql_cnx.cursor()
-        name_row = "name"
-        request = "SELECT %s FROM mantis_project_table WHERE id=%s LIMIT 1" % (name_row, str(id))
-        cursor.execute(request)
-        return cursor.fetchone()[name_row]
-
     def get_issue_tags_by_id(self, id):
+        return self.get_issue_tags_by_ids([id]).get(int(id), [])
+
+    def get_issue_tags_by_ids(self, ids):
+        result = {}
+        if not len(ids):
+            return result
         cursor = self.sql_cnx.cursor()
         name_row = "name"
-        request = "SELECT %s FROM mantis_tag_table WHERE id IN (SELECT tag_id FROM mantis_bug_tag_table WHERE bug_id = %s) LIMIT 1" % (
-        name_row, str(id))
+        request = "SELECT bt.bug_id, t.%s FROM mantis_bug_tag_table bt JOIN mantis_tag_table t ON t.id = bt.tag_id " % name_row
+        request += "WHERE bt.bug_id IN (%s)" % self._to_sql_list(ids)
         cursor.execute(request)
-        return [row[name_row] for row in cursor]
+        for row in cursor:
+            result.setdefault(row["bug_id"], []).append(row[name_row])
+        return result
 
     def _to_epoch_time(self, time):
         if time is None:
@@ -359,3 +372,7 @@ class MantisClient(object):
         if len(time):
             return str(int(time) * 1000)
         return ""
+
+    @staticmethod
+    def _to_sql_list(ids):
+        return ", ".join([str(int(id)) for id in ids])
@@ -6,9 +6,11 @@ if sys.version_info >= (3, 0):
     print("\nThe script doesn't support python 3. Please use python 2.7+\n")
     sys.exit(1)
 
-import urllib2
 from youtrack.connection import Connection
 from youtrackutils.mantis.mantisClient import MantisClient
+from youtrackutils.utils.commands import execute_command_for_issues
+from youtrackutils.utils.attachments import AttachmentUploader
+from youtrackutils.utils.pipeline import Pipeline
 from youtrack import *
 import youtrackutils.mantis
 import youtrackutils.mantis.defaultMantis
@@ -267,31 +269,55 @@ def add_values_to_fields(connection, project_id, mantis_field_name, values, mant
         add_values_to_bundle_safe(connection, bundle, yt_values)
 
 
-def import_attachments(issue_attachments, issue_id, target):
+def import_attachments(issue_attachments, issue_id, target, uploader):
     for attachment in issue_attachments:
         print("Processing issue attachment [ %s ]" % str(attachment.id))
-        content = StringIO(attachment.content)
         author_login = "guest"
         if attachment.author is not None:
             author = to_yt_user(attachment.author)
             target.importUsers([author])
             author_login = author.login
-        try:
+
+        def upload(attachment=attachment, author_login=author_login):
             target.importAttachment(
                 issue_id,
                 attachment.filename,
-                content,
+                StringIO(attachment.content),
                 author_login,
                 attachment.file_type,
                 None,
                 attachment.date_added)
-        except YouTrackException:
-            print("Failed to import attachment")
-        except urllib2.HTTPError as e:
-            msg = 'Failed to import attachment [%s] for issue [%s]. Exception: [%s]' % (attachment.filename, issue_id, str(e))
-            if isinstance(msg, unicode):
-                msg = msg.encode('utf-8')
-            print(msg)
+
+        uploader.submit(issue_id, attachment.filename, upload,
+                        len(attachment.content or ""))
+
+
+def read_issues(client, project_id, max_count):
+    # All reads from the database happen here: the connection can't be
+    # shared with the thread that imports issues
+    after = 0
+    while True:
+        mantis_issues = client.get_mantis_issues(project_id, after, max_count)
+        if not len(mantis_issues):
+            return
+        after = int(mantis_issues[-1]['id'])
+        issue_tags = client.get_issue_tags_by_ids([issue['id'] for issue in mantis_issues])
+        attachments = dict([(issue['id'], client.get_attachments(issue['id']))
+                            for issue in mantis_issues])
+        yield mantis_issues, issue_tags, attachments
+
+
+def import_batch(target, uploader, project_id, assignee_group, tagged_issues,
+                 mantis_issues, issue_tags, attachments):
+    target.importIssues(project_id, assignee_group,
+        [to_yt_issue(issue, project_id, target) for issue in mantis_issues])
+    # import attachments
+    for issue in mantis_issues:
+        issue_id = "%s-%s" % (project_id, issue['id'])
+        import_attachments(attachments[issue['id']], issue_id, target,
+                           uploader)
+        for tag in issue_tags.get(int(issue['id']), []):
+            tagged_issues.setdefault(tag, []).append(issue_id)
 
 
 def is_prefix_of_any_other_tag(tag, other_tags):
@@ -301,34 +327,15 @@ def is_prefix_of_any_other_tag(tag, other_tags):
     return False
 
 
-def import_tags(source, target, project_ids, collected_tags):
-    tags_to_import_now = set([])
-    tags_to_import_after = set([])
-    for tag in collected_tags:
-        if is_prefix_of_any_other_tag(tag, collected_tags):
-            tags_to_import_after.add(tag)
-        else:
-            tags_to_import_now.add(tag)
-    max = 100
-    for project_id in project_ids:
-        go_on = True
-        after = 0
-        while go_on:
-            issues = source.get_mantis_issues(project_id, after, max)
-            go_on = False
-            for issue in issues:
-                go_on = True
-                issue_id = issue['id']
-                issue_tags = source.get_issue_tags_by_id(issue_id)
-                for tag in issue_tags:
-                    if tag in tags_to_import_now:
-                        try:
-                            target.executeCommand("%s-%s" % (project_id, issue_id), "tag " + tag)
-                        except YouTrackException:
-                            pass
-            after += max
-    if len(tags_to_import_after):
-        import_tags(source, target, project_ids, tags_to_import_after)
+def import_tags(target, tagged_issues):
+    # tags that are prefixes of other tags are applied after those tags
+    tags = set(tagged_issues.keys())
+    while len(tags):
+        tags_to_import_now = set([tag for tag in tags if not is_prefix_of_any_other_tag(tag, tags)])
+        for tag in tags_to_import_now:
+            print("Processing tag [ %s ]" % tag.encode('utf-8'))
+            execute_command_for_issues(target, tagged_issues[tag], "tag " + tag)
+        tags -= tags_to_import_now
 
 
 def mantis2youtrack(target_url, target_login, target_pass, mantis_db_name, mantis_db_host, mantis_db_port,
@@ -345,6 +352,7 @@ def mantis2youtrack(target_url, target_login, target_pass, mantis_db_name, manti
 
     #connacting to yt
     target = Connection(target_url, target_login, target_pass)
+    uploader = AttachmentUploader(target_url)
     #connacting to mantis
     client = MantisClient(mantis_db_host, int(mantis_db_port), mantis_db_login,
                           mantis_db_pass, mantis_db_name, youtrackutils.mantis.CHARSET, youtrackutils.mantis.BATCH_SUBPROJECTS)
@@ -385,7 +393,7 @@ def mantis2youtrack(target_url, target_login, target_pass, mantis_db_name, manti
 
     print("Creating custom fields definitions finished")
 
-    issue_tags = set([])
+    tagged_issues = dict([])
     for name in mantis_project_names:
         project_id = str(client.get_project_id_by_name(name))
         name = name.replace("/", " ")
@@ -426,28 +434,17 @@ def mantis2youtrack(target_url, target_login, target_pass, mantis_db_name, manti
         print("Attaching custom fields to project [ %s ] finished" % project_id)
 
         print("Importing issues to project [ %s ]" % project_id)
-        max_count = 100
-        after = 0
-        go_on = True
-        while go_on:
-            go_on = False
-            mantis_issues = client.get_mantis_issues(project_id, after, max_count)
-            after += max_count
-            if len(mantis_issues):
-                go_on = True
-                target.importIssues(project_id, name + " Assignees",
-                    [to_yt_issue(issue, project_id, target) for issue in mantis_issues])
-
-                # import attachments
-                for issue in mantis_issues:
-                    issue_attachments = client.get_attachments(issue['id'])
-                    issue_id = "%s-%s" % (project_id, issue['id'])
-                    import_attachments(issue_attachments, issue_id, target)
-                    issue_tags |= set(client.get_issue_tags_by_id(issue['id']))
+        pipeline = Pipeline(read_issues(client, project_id, 100))
+        pipeline.add_stage('import', lambda batch: import_batch(
+            target, uploader, project_id, name + " Assignees", tagged_issues,
+            *batch))
+        pipeline.run()
+        print(pipeline.summary())
 
         print("Importing issues to project [ %s ] finished" % project_id)
 
-    import_tags(client, target, project_ids, issue_tags)
+    uploader.join()
+    import_tags(target, tagged_issues)
 
     print("Importing issue links")
     go_on = True
@@ -465,6 +462,7 @@ def mantis2youtrack(target_url, target_login, target_pass, mantis_db_name, manti
         print(target.importLinks(yt_issue_links))
 
     print("Importing issue links finished")
+    print(client.user_cache.summary())
 
 if __name__ == "__main__":
     main()
@@ -9,6 +9,7 @@ if sys.version_info >= (3, 0):
 from youtrack import Issue, YouTrackException
 from youtrack.connection import Connection
 from youtrack.sync.links import LinkImporter
+from youtrackutils.utils.workitems import get_new_workitems, get_authors
 
 PREDEFINED_FIELDS = ["summary", "description", "created", "updated",
                      "updaterName", "resolved", "reporterName",
@@ -172,34 +173,19 @@ def do_move(source_url, source_login, source_password,
     if get_time_tracking_state(
             source, target, source_issue_id.split('-')[0],
             target_project_id):
-        workitems = source.getWorkItems(source_issue_id)
-        if workitems:
-            existing_workitems = dict()
-            target_workitems = target.getWorkItems(
-                target_project_id + '-' + target_issue_number)
-            if target_workitems:
-                for w in target_workitems:
-                    _id = '%s\n%s\n%s' % (w.date, w.authorLogin, w.duration)
-                    if hasattr(w, 'description'):
-                        _id += '\n%s' % w.description
-                    existing_workitems[_id] = w
-            new_workitems = []
-            for w in workitems:
-                _id = '%s\n%s\n%s' % (w.date, w.authorLogin, w.duration)
-                if hasattr(w, 'description'):
-                    _id += '\n%s' % w.description
-                if _id not in existing_workitems:
-                    new_workitems.append(w)
-            if new_workitems:
-                print("Process workitems for issue [ " + source_issue_id + "]")
-                try:
-                    for w in new_workitems:
-                        check_user(w.authorLogin, source, target)
-                    target.importWorkItems(
-                        target_project_id + '-' + target_issue_number,
-                        new_workitems)
-                except YouTrackException as e:
-                    print("Failed to import workitems: " + str(e))
+        new_workitems = get_new_workitems(
+            source, target, source_issue_id,
+            target_project_id + '-' + target_issue_number)
+        if new_workitems:
+            print("Process workitems for issue [ " + source_issue_id + "]")
+            try:
+                for login in get_authors(new_workitems):
+                    check_user(login, source, target)
+                target.importWorkItems(
+                    target_project_id + '-' + target_issue_number,
+                    new_workitems)
+            except YouTrackException as e:
+                print("Failed to import workitems: " + str(e))
 
     # links
     link_importer = LinkImporter(target)
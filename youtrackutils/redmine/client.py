@@ -1,8 +1,11 @@
 import pprint
+from multiprocessing.pool import ThreadPool
 
 from pyactiveresource.activeresource import ActiveResource
 from pyactiveresource.connection import ResourceNotFound, MethodNotAllowed, ServerError
 
+from youtrackutils.utils.http import ConnectionPool
+
 
 class RedmineResource(ActiveResource):
     root_element = None
@@ -71,9 +74,15 @@ class RedmineException(Exception):
     pass
 
 
+DEFAULT_WORKERS = 8
+
+
 class RedmineClient(object):
 
-    def __init__(self, api_key, url, login=None, password=None):
+    def __init__(self, api_key, url, login=None, password=None,
+                 workers=DEFAULT_WORKERS):
+        self._pool = ThreadPool(max(1, workers))
+        self._downloads = ConnectionPool()
         RedmineResource.site = url
         if api_key is not None:
             RedmineResource.headers = {'X-Redmine-API-Key': api_key}
@@ -112,6 +121,14 @@ class RedmineClient(object):
             return [self.get_project(id_) for id_ in project_ids]
         return Project.find()
 
+    def open_attachment(self, url):
+        """Returns a response to read the attachment content from.
+
+        Downloads reuse keep-alive connections, the response has to be read
+        to the end or closed.
+        """
+        return self._downloads.open(url, self.headers)
+
     def get_issues(self, project_id=None):
         return Issue.find(None, None, project_id=project_id)
 
@@ -120,7 +137,6 @@ class RedmineClient(object):
             include='journals,assigned_to_id,attachments,children,relations')
 
     def get_project_issues(self, _id, _limit=None, _offset=None, _skip_on_error=False):
-        return_data = []
         if _limit:
             if _offset is None:
                 _offset = 0
@@ -131,26 +147,40 @@ class RedmineClient(object):
                                 offset=_offset, sort='id', status_id='*')
         else:
             issues = Issue.find(None, None, project_id=_id, sort='id', status_id='*')
+        issue_ids = []
         for issue in issues:
             if (hasattr(issue, 'id')):
-                try:
-                    details = self.get_issue_details(issue.id)
-                    return_data.append(details)
-                except ServerError, se:
-                    print "Wasn't able to process issue " + issue.id
-                    if not _skip_on_error:
-                        raise se
+                issue_ids.append(issue.id)
             else:
                 for packed_issue in issue['issues']:
-                    try:
-                        details = self.get_issue_details(packed_issue['id'])
-                        return_data.append(details)
-                    except ServerError, se:
-                        print "Wasn't able to process issue " + packed_issue['id']
-                        if not _skip_on_error:
-                            raise se
+                    issue_ids.append(packed_issue['id'])
+        # Details are fetched in parallel, map() keeps the order of ids
+        return_data = []
+        for issue_id, details in zip(issue_ids, self._pool.map(
+                self._get_issue_details_safe, issue_ids)):
+            if isinstance(details, ServerError):
+                print "Wasn't able to process issue " + str(issue_id)
+                if not _skip_on_error:
+                    raise details
+            else:
+                return_data.append(details)
         return return_data
 
+    def iter_project_issues(self, _id, _limit, _offset=0, _skip_on_error=False):
+        """Yields (offset, issues) for every page of project issues."""
+        while True:
+            issues = self.get_project_issues(_id, _limit, _offset, _skip_on_error)
+            if not issues:
+                return
+            yield _offset, issues
+            _offset += _limit
+
+    def _get_issue_details_safe(self, issue_id):
+        try:
+            return self.get_issue_details(issue_id)
+        except ServerError, se:
+            return se
+
     def get_user(self, user_id):
         return User.find(user_id, None, include='groups')
 
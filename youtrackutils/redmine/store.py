@@ -0,0 +1,54 @@
+import sqlite3
+
+
+class IssueStore(object):
+    """Numbers of imported issues and relations between them.
+
+    Both are kept in a temporary SQLite database, which is removed on
+    close(), so memory use doesn't grow with the number of issues and
+    relations. Redmine reports a relation for both of its issues, the
+    duplicate is dropped on insert.
+    """
+
+    def __init__(self):
+        self._db = sqlite3.connect('')
+        self._db.executescript("""
+            PRAGMA synchronous = OFF;
+            PRAGMA journal_mode = OFF;
+            CREATE TABLE issue (
+                rid INTEGER PRIMARY KEY, project TEXT, number INTEGER);
+            CREATE TABLE relation (
+                type TEXT, source INTEGER, target INTEGER,
+                PRIMARY KEY (type, source, target));
+        """)
+
+    def get_issue(self, rid):
+        """Returns (project_id, number) of the issue or None."""
+        return self._db.execute(
+            "SELECT project, number FROM issue WHERE rid = ?",
+            (rid,)).fetchone()
+
+    def add_issue(self, rid, project_id, number):
+        self._db.execute("INSERT INTO issue VALUES (?, ?, ?)",
+                         (rid, project_id, number))
+
+    def add_relation(self, relation_type, source_rid, target_rid):
+        self._db.execute("INSERT OR IGNORE INTO relation VALUES (?, ?, ?)",
+                         (relation_type, source_rid, target_rid))
+
+    def iter_relations(self):
+        """Yields (type, source rid, target rid, source id, target id).
+
+        Ids are None for issues that weren't imported.
+        """
+        cursor = self._db.execute("""
+            SELECT r.type, r.source, r.target,
+                   s.project || '-' || s.number, t.project || '-' || t.number
+            FROM relation r
+                LEFT JOIN issue s ON s.rid = r.source
+                LEFT JOIN issue t ON t.rid = r.target""")
+        for row in cursor:
+            yield row
+
+    def close(self):
+        self._db.close()
@@ -13,12 +13,16 @@ import traceback
 import re
 import getopt
 import calendar
-import urllib2
 import youtrackutils.redmine
 import youtrack
-import time
 from youtrack.connection import Connection
-from youtrack.importHelper import create_bundle_safe
+from youtrackutils.utils.attachments import AttachmentUploader, \
+    DEFAULT_WORKERS, import_from_attachment
+from youtrackutils.utils.journal import Journal, journal_path, link_key
+from youtrackutils.utils.schema import TargetSchema
+from youtrackutils.utils.pipeline import Pipeline
+from youtrackutils.redmine.client import DEFAULT_WORKERS as RM_WORKERS
+from youtrackutils.redmine.store import IssueStore
 from datetime import datetime
 from dateutil import parser
 
@@ -75,6 +79,15 @@ Options:
     -M   Treat descriptions and comments as Markdown while importing
     -l   Create a field linking imported redmine tasks with youtrack's
     -s   Skip an issue in case of server errors (instead terminating import)
+    -F WORKERS,
+         Number of issues to fetch from Redmine in parallel (default %d)
+    -j WORKERS,
+         Number of attachments to upload in parallel (default %d)
+    -R RATE,
+         Max number of attachment uploads per second (not limited by default)
+    --resume
+         Continue an interrupted import skipping the work that was already
+         done (uses the journal file in the current directory)
 
 Examples:
 
@@ -86,13 +99,15 @@ Examples:
     Import issues using the mapping file:
 
     $ %s -T token -a key http://redmine.company.com http://yt.company.com test 
-""" % (basename, help_url, basename, basename))
+""" % (basename, help_url, RM_WORKERS, DEFAULT_WORKERS, basename,
+       basename))
 
 
 def main():
     try:
         params = {}
-        opts, args = getopt.getopt(sys.argv[1:], 'hwsla:gu:p:U:P:m:t:T:d:M')
+        opts, args = getopt.getopt(sys.argv[1:], 'hwsla:gu:p:U:P:m:t:T:d:MF:j:R:',
+                                   ['resume'])
         for opt, val in opts:
             if opt == '-h':
                 usage()
@@ -125,7 +140,15 @@ def main():
                 params['project_lead_login'] = val
             elif opt == '-M':
                 params['use_markdown'] = True
-    except getopt.GetoptError as e:
+            elif opt == '-F':
+                params['rm_workers'] = int(val)
+            elif opt == '-j':
+                params['attachment_workers'] = int(val)
+            elif opt == '-R':
+                params['attachment_rate'] = float(val)
+            elif opt == '--resume':
+                params['resume'] = True
+    except (getopt.GetoptError, ValueError) as e:
         print(e)
         usage()
         sys.exit(1)
@@ -201,8 +224,7 @@ class RedmineImporter(object):
         self._params = params
         self._projects = None
         self._max_issue_ids = {}
-        self._issue_ids = {}
-        self._relations = {}
+        self._issues = IssueStore()
         self._users = {}
         self._groups = {}
         self._subsystems = {}
@@ -212,14 +234,16 @@ class RedmineImporter(object):
         if 'rm_api_key' in params:
             self._source = youtrackutils.redmine.RedmineClient(
                 params['rm_api_key'],
-                params['rm_url']
+                params['rm_url'],
+                workers=params.get('rm_workers', RM_WORKERS)
             )
         elif 'rm_login' in params:
             self._source = youtrackutils.redmine.RedmineClient(
                 None,
                 params['rm_url'],
                 params.get('rm_login'),
-                params.get('rm_password')
+                params.get('rm_password'),
+                workers=params.get('rm_workers', RM_WORKERS)
             )
         else:
             print("You have to provide Redmine API key or login/password")
@@ -255,6 +279,14 @@ class RedmineImporter(object):
                         continue
             self._params['project_lead_login'] = project_lead
 
+        self._uploader = AttachmentUploader(
+            params['yt_url'],
+            workers=params.get('attachment_workers', DEFAULT_WORKERS),
+            rate=params.get('attachment_rate'))
+        self._journal = Journal(journal_path('redmine2youtrack'),
+                                params.get('resume'))
+        self._schema = TargetSchema(self._target)
+
     def do_import(self, project_ids):
         try:
             projects2import = self._get_projects(project_ids)
@@ -262,14 +294,19 @@ class RedmineImporter(object):
             print('FATAL:', e)
             sys.exit(1)
 
-        print('===> Import Roles')
-        self._import_roles()
+        if not self._journal.is_done('roles'):
+            print('===> Import Roles')
+            self._import_roles()
+            self._journal.done('roles')
 
         for project in projects2import.values():
             self._import_project(project)
+        self._uploader.join()
 
         print('===> Apply Relations')
         self._apply_relations()
+        self._issues.close()
+        self._journal.close()
 
     def _get_projects(self, project_ids=None, by_internal_id=False):
         if by_internal_id:
@@ -320,16 +357,18 @@ class RedmineImporter(object):
 
         print("===> Importing Project '%s' (%s)" %
               (project_name.encode('utf-8'), project_id.encode('utf-8')))
-        try:
-            print('Creating project...')
-            self._target.getProject(project_id)
-            print('Project already exists')
-        except youtrack.YouTrackException:
-            self._target.createProjectDetailed(
-                project_id, project_name, project_desc, project_lead)
-            print('Project successfully created')
-        print('Import project members...')
-        self._import_members(project)
+        if not self._journal.is_done('project:' + project_id):
+            try:
+                print('Creating project...')
+                self._target.getProject(project_id)
+                print('Project already exists')
+            except youtrack.YouTrackException:
+                self._target.createProjectDetailed(
+                    project_id, project_name, project_desc, project_lead)
+                print('Project successfully created')
+            print('Import project members...')
+            self._import_members(project)
+            self._journal.done('project:' + project_id)
         print('Import issues...')
         self._import_issues(project)
 
@@ -442,19 +481,17 @@ class RedmineImporter(object):
         return '%s Assignees' % project_id.upper()
 
     def _get_yt_issue_id(self, issue, as_number_in_project=False):
-        project_id = self._projects['by_iid'][issue.project.id].identifier
-        new_id = self._max_issue_ids.get(project_id, 0) + 1
         rid = int(issue.id)
-        if rid not in self._issue_ids:
+        known = self._issues.get_issue(rid)
+        if known is None:
+            project_id = self._projects['by_iid'][issue.project.id].identifier
+            new_id = self._max_issue_ids.get(project_id, 0) + 1
             self._max_issue_ids[project_id] = new_id
-            self._issue_ids[rid] = {'id': new_id, 'project_id': project_id}
+            self._issues.add_issue(rid, project_id, new_id)
+            known = (project_id, new_id)
         if as_number_in_project:
-            return self._issue_ids[rid]['id']
-        return self._to_yt_issue_id(rid)
-
-    def _to_yt_issue_id(self, iid):
-        issue = self._issue_ids[iid]
-        return '%s-%d' % (issue['project_id'], issue['id'])
+            return known[1]
+        return '%s-%d' % known
 
     def _get_yt_issue_number(self, issue):
         return self._get_yt_issue_id(issue, True)
@@ -529,23 +566,36 @@ class RedmineImporter(object):
 
     def _import_issues(self, project, limit=CHUNK_SIZE):
         project_id = project.identifier
-        offset = 0
-        assignee_group = self._get_assignee_group_name(project_id)
-        while True:
-            issues = self._source.get_project_issues(project.id, limit, offset,
-                                                     self._params.get('skip_on_error', False))
-            if not issues:
-                break
-            issues = [issue for issue in issues if issue.project.id == project.id]
-            self._target.importIssues(project_id, assignee_group,
-                                      [self._make_issue(issue, project_id) for issue in issues])
+        # Chunks before this offset were imported by the interrupted run.
+        # They are still read to restore issue numbers and relations.
+        imported_offset = int(self._journal.get_position(project_id, 0))
+        # Next page is read from Redmine while the current one is imported
+        pages = self._source.iter_project_issues(
+            project.id, limit, 0, self._params.get('skip_on_error', False))
+        pipeline = Pipeline(pages).add_stage(
+            'import', lambda page: self._import_page(
+                project, page[0], page[1], imported_offset, limit))
+        pipeline.run()
+        print(pipeline.summary())
+
+    def _import_page(self, project, offset, issues, imported_offset, limit):
+        project_id = project.identifier
+        issues = [issue for issue in issues if issue.project.id == project.id]
+        if offset < imported_offset:
             for issue in issues:
-                self._collect_relations(issue)
-                self._add_attachments(issue)
-                if self._params.get('import_time_entries', False):
-                    self._enable_timetracking(project)
-                    self._add_work_items(issue)
-            offset += limit
+                self._get_yt_issue_id(issue)
+        else:
+            yt_issues = [self._make_issue(issue, project_id) for issue in issues]
+            self._schema.flush()
+            self._target.importIssues(
+                project_id, self._get_assignee_group_name(project_id), yt_issues)
+        for issue in issues:
+            self._collect_relations(issue)
+            self._add_attachments(issue)
+            if self._params.get('import_time_entries', False):
+                self._enable_timetracking(project)
+                self._add_work_items(issue)
+        self._journal.set_position(project_id, offset + limit)
 
     def _make_issue(self, redmine_issue, project_id):
         issue = youtrack.Issue()
@@ -621,20 +671,20 @@ class RedmineImporter(object):
             issue[field_name] = self._get_value_presentation(field_type, value)
 
     def _create_field(self, project_id, field_name, field_type):
-        project_fields = self._target.getProjectCustomFields(project_id)
-        if field_name.lower() not in [f.name.lower() for f in project_fields]:
-            all_fields = self._target.getCustomFields()
-            if field_name.lower() not in [f.name.lower() for f in all_fields]:
-                self._target.createCustomFieldDetailed(
-                    field_name, field_type, False, True, False, {})
+        field = self._schema.get_project_field(project_id, field_name)
+        if field is None:
+            if not self._schema.has_field(field_name):
+                self._schema.create_field(field_name, field_type)
             if field_type in ('string', 'date', 'integer', 'float', 'period'):
-                self._target.createProjectCustomFieldDetailed(
+                self._schema.attach_field(
                     project_id, field_name, 'No ' + field_name)
             else:
                 bundle_name = field_name + ' bundle'
-                create_bundle_safe(self._target, bundle_name, field_type)
-                self._target.createProjectCustomFieldDetailed(
+                self._schema.create_bundle(field_type, bundle_name)
+                self._schema.attach_field(
                     project_id, field_name, 'No ' + field_name, {'bundle': bundle_name})
+            field = self._schema.get_project_field(project_id, field_name)
+        return field
 
     def _create_field_value(self, project_id, field_name, field_type, value):
         if field_type.startswith('user'):
@@ -648,22 +698,16 @@ class RedmineImporter(object):
             return value
         if field_name in youtrack.EXISTING_FIELDS:
             return value
-        self._create_field(project_id, field_name, field_type)
+        field = self._create_field(project_id, field_name, field_type)
         if field_type in ('string', 'date', 'integer', 'float', 'period'):
             return value
-        field = self._target.getProjectCustomField(project_id, field_name)
-        bundle = self._target.getBundle(field_type, field.bundle)
-        try:
-            if hasattr(value, 'value'):
-                value = value.value
-            elif hasattr(value, 'name'):
-                if not (field_type.startswith('version') or
-                        field_type.startswith('ownedField')):
-                    value = value.name
-            self._target.addValueToBundle(bundle, value)
-        except youtrack.YouTrackException as e:
-            if e.response.status != 409 or e.response.reason.lower() != 'conflict':
-                print(e)
+        if hasattr(value, 'value'):
+            value = value.value
+        elif hasattr(value, 'name'):
+            if not (field_type.startswith('version') or
+                    field_type.startswith('ownedField')):
+                value = value.name
+        self._schema.add_bundle_value(field_type, field.bundle, value)
         return value
 
     def _get_value_presentation(self, field_type, value):
@@ -722,6 +766,8 @@ class RedmineImporter(object):
         self._target.setProjectTimeTrackingSettings(project.identifier, enabled=True)
 
     def _add_work_items(self, issue):
+        if self._journal.has('workitems', issue.id):
+            return
         import_data = []
         work_items = self._source.get_time_entries(issue.id)
         flatten_work_items = []
@@ -742,33 +788,28 @@ class RedmineImporter(object):
             import_data.append(work_item)
         if import_data:
             self._target.importWorkItems(self._get_yt_issue_id(issue), import_data)
+        self._journal.add('workitems', issue.id)
 
     def _add_attachments(self, issue):
         if not hasattr(issue, 'attachments'):
             return
-        max_attempts = 5
+        issue_id = self._get_yt_issue_id(issue)
         for attach in issue.attachments:
+            if self._journal.has('attachment', attach.id):
+                continue
             attach.author.login = self._create_user(attach.author).login
             if not attach.author.login:
                 attach.author.login = 'guest'
-            attempts = max_attempts
-            while attempts:
-                attempts -= 1
-                try:
-                    self._target.createAttachmentFromAttachment(
-                        self._get_yt_issue_id(issue),
-                        RedmineAttachment(attach, self._source))
-                    break
-                except Exception as e:
-                    print(e)
-                    if attempts:
-                        delay = 30 + (max_attempts - attempts - 1) * 10
-                        print("Can't import attachment: %s. Retry in %d s." %
-                              (attach.filename, delay))
-                        time.sleep(delay)
-                    else:
-                        print('Failed to import attachment: %s. Skipped.' %
-                              attach.filename)
+            a = RedmineAttachment(attach, self._source)
+
+            def on_done(ok, attach_id=attach.id):
+                if ok:
+                    self._journal.add('attachment', attach_id)
+
+            self._uploader.submit(
+                issue_id, a.name,
+                lambda a=a: import_from_attachment(self._target, issue_id, a),
+                int(getattr(attach, 'filesize', 0)), on_done)
 
     def _collect_relations(self, issue):
         link_types = {
@@ -792,40 +833,36 @@ class RedmineImporter(object):
                 self._push_relation(issue.id, child.id, 'subtask')
 
     def _push_relation(self, from_iid, to_iid, relation_type):
-        from_iid = int(from_iid)
-        to_iid = int(to_iid)
-        if relation_type not in self._relations:
-            self._relations[relation_type] = {}
-        relations = self._relations[relation_type]
-        if from_iid not in relations:
-            relations[from_iid] = {}
-        relations[from_iid][to_iid] = None
+        self._issues.add_relation(relation_type, int(from_iid), int(to_iid))
 
     def _apply_relations(self, limit=CHUNK_SIZE):
         links = []
-        for link_type, ids in self._relations.items():
-            for from_id, to_ids in ids.items():
-                for to_id in to_ids:
-                    link = youtrack.Link()
-                    link.typeName = link_type
-                    try:
-                        link.source = self._to_yt_issue_id(from_id)
-                        link.target = self._to_yt_issue_id(to_id)
-                    except KeyError:
-                        print("Cannot apply link (%s) to issues: %d and %d" %
-                              (link_type, from_id, to_id))
-                        if hasattr(link, 'source') and link.source:
-                            print("The second issue was not imported")
-                            continue
-                        else:
-                            print("The first issues was not imported")
-                            break
-                    links.append(link)
-                    if len(links) >= limit:
-                        self._target.importLinks(links)
-                        del links[0:]
+        for link_type, from_iid, to_iid, source, target in \
+                self._issues.iter_relations():
+            if source is None or target is None:
+                print("Cannot apply link (%s) to issues: %d and %d" %
+                      (link_type, from_iid, to_iid))
+                if source is not None:
+                    print("The second issue was not imported")
+                else:
+                    print("The first issues was not imported")
+                continue
+            link = youtrack.Link()
+            link.typeName = link_type
+            link.source = source
+            link.target = target
+            if self._journal.has('link', link_key(link)):
+                continue
+            links.append(link)
+            if len(links) >= limit:
+                self._import_links(links)
+                links = []
         if links:
-            self._target.importLinks(links)
+            self._import_links(links)
+
+    def _import_links(self, links):
+        self._target.importLinks(links)
+        self._journal.add_all('link', [link_key(link) for link in links])
 
 
 class RedmineAttachment(object):
@@ -834,10 +871,10 @@ class RedmineAttachment(object):
         self.name = attach.filename
         self.created = str(to_unixtime(attach.created_on))
         self.url = attach.content_url
-        self.headers = source.headers
+        self._source = source
 
     def getContent(self):
-        return urllib2.urlopen(urllib2.Request(self.url, headers=self.headers))
+        return self._source.open_attachment(self.url)
 
 
 if __name__ == '__main__':
@@ -6,9 +6,11 @@ if sys.version_info >= (3, 0):
     print("\nThe script doesn't support python 3. Please use python 2.7+\n")
     sys.exit(1)
 
+import os
 import urllib
 from youtrack.connection import Connection
 from youtrackutils.tracLib.client import Client
+from youtrackutils.utils.attachments import AttachmentUploader
 import youtrack
 import re
 import youtrackutils.tracLib
@@ -330,6 +332,7 @@ def trac2youtrack(target_url, target_login, target_password, project_ID, project
     client = Client(env_path)
     # creating connection to util to import issues in
     target = Connection(target_url, target_login, target_password)
+    uploader = AttachmentUploader(target_url)
 
     # create project
     print("Creating project[%s]" % project_name)
@@ -409,79 +412,74 @@ def trac2youtrack(target_url, target_login, target_password, project_ID, project
         print("Creating project custom fields finished")
 
     print("Importing issues")
-    trac_issues = client.get_issues()
-    yt_issues = list([])
-    counter = 0
-    max = 100
-    for issue in trac_issues:
-        print("Processing issue [ %s ]" % (str(issue.id)))
-        counter += 1
-        if not (issue.reporter in registered_users):
-            yt_user, registered_users = process_non_authorised_user(target, registered_users, issue.reporter)
-            if yt_user is None :
-                issue.reporter = "guest"
-            else:
-                issue.reporter = yt_user
-        if not (issue.owner in registered_users):
-            yt_user, registered_users = process_non_authorised_user(target, registered_users, issue.owner)
-            if yt_user is None :
-                issue.owner = ""
-            else:
-                issue.owner = yt_user
-        legal_cc = set([])
-        for cc in issue.cc:
-            if cc in registered_users:
-                legal_cc.add(cc)
-        issue.cc = legal_cc
-
-        yt_issues.append(to_youtrack_issue(project_ID, issue, check_box_fields))
-        if counter == max:
-            counter = 0
-            print(target.importIssues(project_ID, project_name + ' Assignees', yt_issues))
-            yt_issues = list([])
-    print(target.importIssues(project_ID, project_name + ' Assignees', yt_issues))
-    print('Importing issues finished')
-
-    # importing tags
-    print("Importing keywords")
-    for issue in trac_issues:
-        print("Importing tags from issue [ %s ]" % (str(issue.id)))
-        tags = issue.keywords
-        for t in tags:
-            target.executeCommand(str(project_ID) + "-" + str(issue.id), "tag " + t.encode('utf-8'))
-    print("Importing keywords finished")
-
-    print("Importing attachments")
-    for issue in trac_issues:
-        print("Processing issue [ %s ]" % (str(issue.id)))
-        issue_attach = issue.attachment
-        for attach in issue_attach:
-            print("Processing attachment [ %s ]" % attach.filename.encode('utf-8'))
-            if not (attach.author_name in registered_users):
-                yt_user, registered_users = process_non_authorised_user(target, registered_users, attach.author_name)
-                if yt_user is None:
-                    attach.author_name = "guest"
-                else:
-                    attach.author_name = yt_user
-            content = open(urllib.quote(attach.filename.encode('utf-8')))
-            target.createAttachment(str(project_ID) + "-" + str(issue.id), attach.name, content, attach.author_name,
-                                    created=attach.time)
-    print("Importing attachments finished")
-
-    print("Importing workitems")
     tt_enabled = False
-    for issue in trac_issues:
-        if issue.workitems:
-            if not tt_enabled:
-                tt_settings = target.getProjectTimeTrackingSettings(str(project_ID))
-                if not tt_settings.Enabled:
-                    print("Enabling TimeTracking for the project")
-                    target.setProjectTimeTrackingSettings(str(project_ID), enabled=True)
-                tt_enabled = True
+    for trac_issues in client.get_issue_chunks():
+        yt_issues = list([])
+        for issue in trac_issues:
             print("Processing issue [ %s ]" % (str(issue.id)))
-            workitems = [to_youtrack_workitem(w) for w in issue.workitems]
-            target.importWorkItems(str(project_ID) + "-" + str(issue.id), workitems)
-    print("Importing workitems finished")
+            if not (issue.reporter in registered_users):
+                yt_user, registered_users = process_non_authorised_user(target, registered_users, issue.reporter)
+                if yt_user is None :
+                    issue.reporter = "guest"
+                else:
+                    issue.reporter = yt_user
+            if not (issue.owner in registered_users):
+                yt_user, registered_users = process_non_authorised_user(target, registered_users, issue.owner)
+                if yt_user is None :
+                    issue.owner = ""
+                else:
+                    issue.owner = yt_user
+            legal_cc = set([])
+            for cc in issue.cc:
+                if cc in registered_users:
+                    legal_cc.add(cc)
+            issue.cc = legal_cc
+
+            yt_issues.append(to_youtrack_issue(project_ID, issue, check_box_fields))
+        print(target.importIssues(project_ID, project_name + ' Assignees', yt_issues))
+
+        # importing tags
+        for issue in trac_issues:
+            print("Importing tags from issue [ %s ]" % (str(issue.id)))
+            tags = issue.keywords
+            for t in tags:
+                target.executeCommand(str(project_ID) + "-" + str(issue.id), "tag " + t.encode('utf-8'))
+
+        for issue in trac_issues:
+            issue_attach = issue.attachment
+            for attach in issue_attach:
+                print("Processing attachment [ %s ] for issue [ %s ]" % (attach.filename.encode('utf-8'), str(issue.id)))
+                if not (attach.author_name in registered_users):
+                    yt_user, registered_users = process_non_authorised_user(target, registered_users, attach.author_name)
+                    if yt_user is None:
+                        attach.author_name = "guest"
+                    else:
+                        attach.author_name = yt_user
+                path = urllib.quote(attach.filename.encode('utf-8'))
+
+                def upload(issue_id=str(project_ID) + "-" + str(issue.id),
+                           attach=attach, path=path):
+                    with open(path) as content:
+                        target.createAttachment(issue_id, attach.name, content, attach.author_name,
+                                                created=attach.time)
+
+                uploader.submit(str(project_ID) + "-" + str(issue.id),
+                                attach.name, upload,
+                                os.path.getsize(path))
+
+        for issue in trac_issues:
+            if issue.workitems:
+                if not tt_enabled:
+                    tt_settings = target.getProjectTimeTrackingSettings(str(project_ID))
+                    if not tt_settings.Enabled:
+                        print("Enabling TimeTracking for the project")
+                        target.setProjectTimeTrackingSettings(str(project_ID), enabled=True)
+                    tt_enabled = True
+                print("Processing workitems of issue [ %s ]" % (str(issue.id)))
+                workitems = [to_youtrack_workitem(w) for w in issue.workitems]
+                target.importWorkItems(str(project_ID) + "-" + str(issue.id), workitems)
+    uploader.join()
+    print('Importing issues finished')
 
 if __name__ == "__main__":
     main()
@@ -152,78 +152,98 @@ class Client(object):
             return trac_milestones
 
     def get_issues(self):
-        with self.env.db_query as db:
-            cursor = db.cursor()
-            cursor.execute("SELECT id, type, time, changetime, component, severity, priority, owner, reporter,"
-                           "cc, version, milestone, status, resolution, summary, description, keywords FROM ticket")
-            trac_issues = list([])
-            for row in cursor:
-                issue = TracIssue(row[0])
-                issue.time = to_unix_time(row[2])
-                issue.changetime = to_unix_time(row[3])
-                issue.reporter = self._get_user_login(row[8])
-                if row[9] is not None:
-                    cc = row[9].split(",")
-                    for c in cc:
-                        if len(c) > 0:
-                            cc_name = self._get_user_login(c.strip())
-                            if cc_name is not None:
-                                issue.cc.add(cc_name)
-                issue.summary = row[14]
-                issue.description = row[15]
-                issue.custom_fields["Type"] = row[1]
-                issue.custom_fields["Component"] = None if row[4] is None else row[4].replace("/", "-")
-                issue.custom_fields["Severity"] = row[5]
-                issue.custom_fields["Priority"] = row[6]
-                issue.custom_fields["Owner"] = self._get_user_login(row[7])
-                issue.custom_fields["Version"] = row[10]
-                issue.custom_fields["Milestone"] = row[11]
-                issue.custom_fields["Status"] = row[12]
-                issue.custom_fields["Resolution"] = row[13]
-                if row[16] is not None:
-                    keywords = row[16].rsplit(",")
-                    for kw in keywords:
-                        if len(kw) > 0:
-                            issue.keywords.add(kw.strip())
+        trac_issues = list([])
+        for chunk in self.get_issue_chunks():
+            trac_issues.extend(chunk)
+        return trac_issues
+
+    def get_issue_chunks(self, max_count=100):
+        # Tickets are read by id windows and related rows are loaded for
+        # the whole window, so memory doesn't grow with the ticket count
+        last_id = None
+        while True:
+            with self.env.db_query as db:
+                cursor = db.cursor()
+                request = "SELECT id, type, time, changetime, component, severity, priority, owner, reporter," \
+                          "cc, version, milestone, status, resolution, summary, description, keywords FROM ticket"
+                if last_id is None:
+                    cursor.execute(request + " ORDER BY id LIMIT %s", (max_count,))
+                else:
+                    cursor.execute(request + " WHERE id > %s ORDER BY id LIMIT %s", (last_id, max_count))
+                trac_issues = [self._to_issue(row) for row in cursor]
+                if not len(trac_issues):
+                    return
+                last_id = trac_issues[-1].id
+                issues_by_id = dict([(issue.id, issue) for issue in trac_issues])
+                ids_placeholder = ", ".join(["%s"] * len(trac_issues))
                 #getting custom fields from ticket_custom table
-                with self.env.db_query as db:
-                    custom_field_cursor = db.cursor()
-                    custom_field_cursor.execute("SELECT name, value FROM ticket_custom WHERE ticket=%s", (str(row[0]),))
-                    for cf in custom_field_cursor:
-                        issue.custom_fields[cf[0].capitalize()] = cf[1]
+                custom_field_cursor = db.cursor()
+                custom_field_cursor.execute("SELECT ticket, name, value FROM ticket_custom WHERE ticket IN (%s)" %
+                                            ids_placeholder, list(issues_by_id.keys()))
+                for cf in custom_field_cursor:
+                    issues_by_id[cf[0]].custom_fields[cf[1].capitalize()] = cf[2]
                 # getting attachments from attachment table
-                with self.env.db_query as db:
-                    attachment_cursor = db.cursor()
-                    attachment_cursor.execute("SELECT filename, size, time, description, author FROM attachment WHERE "
-                                              "type = %s AND id = %s", ("ticket", str(issue.id)))
-                    #path = self.env_path + "/attachments/ticket/" + str(issue.id) + "/"
-                    for elem in attachment_cursor:
-                        #at = TracAttachment(path + elem[0])
-                        at = TracAttachment(Attachment._get_path(self.env.path, 'ticket', str(issue.id), elem[0]))
-                        at.name = elem[0]
-                        at.size = elem[1]
-                        at.time = to_unix_time(elem[2])
-                        at.description = elem[3]
-                        at.author_name = elem[4]
-                        issue.attachment.add(at)
-                    trac_issues.append(issue)
+                attachment_cursor = db.cursor()
+                attachment_cursor.execute("SELECT id, filename, size, time, description, author FROM attachment WHERE "
+                                          "type = %%s AND id IN (%s)" % ids_placeholder,
+                                          ["ticket"] + [str(id) for id in issues_by_id.keys()])
+                for elem in attachment_cursor:
+                    at = TracAttachment(Attachment._get_path(self.env.path, 'ticket', elem[0], elem[1]))
+                    at.name = elem[1]
+                    at.size = elem[2]
+                    at.time = to_unix_time(elem[3])
+                    at.description = elem[4]
+                    at.author_name = elem[5]
+                    issues_by_id[int(elem[0])].attachment.add(at)
                 #getting comments
-                with self.env.db_query as db:
-                    change_cursor = db.cursor()
-                    change_cursor.execute("SELECT time, author, newvalue, oldvalue FROM ticket_change WHERE ticket = %s AND field = %s ORDER BY time DESC", (str(row[0]), "comment",))
-                    for elem in change_cursor:
-                        if (elem[2] is None) or (not len(elem[2].lstrip())):
-                            continue
-                        comment = TracComment(to_unix_time(elem[0]))
-                        comment.author = str(elem[1])
-                        comment.content = unicode(elem[2])
-                        comment.id = elem[3]
-                        issue.comments.add(comment)
-                #getting workitems
-                for ttp in self._timetracking_plugins:
-                    issue.workitems.update(set(ttp[row[0]]))
-            return trac_issues
+                change_cursor = db.cursor()
+                change_cursor.execute("SELECT ticket, time, author, newvalue, oldvalue FROM ticket_change WHERE "
+                                      "field = %%s AND ticket IN (%s) ORDER BY time DESC" % ids_placeholder,
+                                      ["comment"] + list(issues_by_id.keys()))
+                for elem in change_cursor:
+                    if (elem[3] is None) or (not len(elem[3].lstrip())):
+                        continue
+                    comment = TracComment(to_unix_time(elem[1]))
+                    comment.author = str(elem[2])
+                    comment.content = unicode(elem[3])
+                    comment.id = elem[4]
+                    issues_by_id[elem[0]].comments.add(comment)
+            #getting workitems
+            for ttp in self._timetracking_plugins:
+                workitems = ttp.get_workitems([issue.id for issue in trac_issues])
+                for issue in trac_issues:
+                    issue.workitems.update(set(workitems[issue.id]))
+            yield trac_issues
 
+    def _to_issue(self, row):
+        issue = TracIssue(row[0])
+        issue.time = to_unix_time(row[2])
+        issue.changetime = to_unix_time(row[3])
+        issue.reporter = self._get_user_login(row[8])
+        if row[9] is not None:
+            cc = row[9].split(",")
+            for c in cc:
+                if len(c) > 0:
+                    cc_name = self._get_user_login(c.strip())
+                    if cc_name is not None:
+                        issue.cc.add(cc_name)
+        issue.summary = row[14]
+        issue.description = row[15]
+        issue.custom_fields["Type"] = row[1]
+        issue.custom_fields["Component"] = None if row[4] is None else row[4].replace("/", "-")
+        issue.custom_fields["Severity"] = row[5]
+        issue.custom_fields["Priority"] = row[6]
+        issue.custom_fields["Owner"] = self._get_user_login(row[7])
+        issue.custom_fields["Version"] = row[10]
+        issue.custom_fields["Milestone"] = row[11]
+        issue.custom_fields["Status"] = row[12]
+        issue.custom_fields["Resolution"] = row[13]
+        if row[16] is not None:
+            keywords = row[16].rsplit(",")
+            for kw in keywords:
+                if len(kw) > 0:
+                    issue.keywords.add(kw.strip())
+        return issue
 
     def get_custom_fields_declared(self):
         ini_file_path = self.env_path + "/conf/trac.ini"
@@ -8,24 +8,40 @@ class TimeTrackingPlugin(object):
     def __init__(self, trac_env):
         self.env = trac_env
 
-    def _get_issue_workitems(self, ticket_id):
+    def _get_workitems_rows(self, ticket_ids):
         raise NotImplementedError
 
+    def _get_issue_workitems(self, ticket_id):
+        return self.get_workitems([ticket_id])[ticket_id]
+
     def _build_workitem(self, time, duration, author, comment=None):
         return TracWorkItem(time, duration, author, comment)
 
+    def get_workitems(self, ticket_ids):
+        """Returns workitems of all given tickets grouped by ticket id"""
+        result = dict([(ticket_id, []) for ticket_id in ticket_ids])
+        if len(result):
+            for row in self._get_workitems_rows(result.keys()):
+                result[row[0]].append(self._build_workitem(*row[1:]))
+        return result
+
     def __getitem__(self, id_):
         return self._get_issue_workitems(id_)
 
 
+def _to_sql_list(ticket_ids):
+    return ", ".join([str(int(ticket_id)) for ticket_id in ticket_ids])
+
+
 class TimeHoursPlugin(TimeTrackingPlugin):
     @classmethod
     def get_name(self):
         return 'trachours'
 
-    def _get_issue_workitems(self, ticket_id):
+    def _get_workitems_rows(self, ticket_ids):
         query = """
             SELECT
+                ticket,
                 time_started * 1000, /* convert to format with millis */
                 seconds_worked,
                 worker,
@@ -33,17 +49,12 @@ class TimeHoursPlugin(TimeTrackingPlugin):
             FROM
                 ticket_time
             WHERE
-                ticket=%s
+                ticket IN (%s)
             ORDER BY
-                time_started DESC
-        """ % str(ticket_id)
-
-        workitems = []
-        for time, duration, author, comment in self.env.db_query(query):
-            workitems.append(
-                self._build_workitem(time, duration, author, comment))
+                ticket, time_started DESC
+        """ % _to_sql_list(ticket_ids)
 
-        return workitems
+        return self.env.db_query(query)
 
 
 class TimingAndEstimationPlugin(TimeTrackingPlugin):
@@ -51,28 +62,25 @@ class TimingAndEstimationPlugin(TimeTrackingPlugin):
     def get_name(self):
         return 'timingandestimationplugin'
 
-    def _get_issue_workitems(self, ticket_id):
+    def _get_workitems_rows(self, ticket_ids):
         query = """
             SELECT
+                ticket,
                 time,
                 newvalue * 3600, /* convert hours to seconds */
                 author
             FROM
                 ticket_change
             WHERE
-                ticket=%s
+                ticket IN (%s)
             AND
                 field='hours'
             ORDER BY
-                time DESC
-        """ % str(ticket_id)
-
-        workitems = []
-        for time, duration, author in self.env.db_query(query):
-            workitems.append(
-                self._build_workitem(to_unix_time(time), duration, author))
+                ticket, time DESC
+        """ % _to_sql_list(ticket_ids)
 
-        return workitems
+        return [(ticket, to_unix_time(time), duration, author)
+                for ticket, time, duration, author in self.env.db_query(query)]
 
 
 plugins = (TimeHoursPlugin,
@@ -0,0 +1,218 @@
+import Queue
+import httplib
+import random
+import socket
+import sys
+import threading
+import time
+import traceback
+import urllib2
+import urlparse
+
+from youtrack import YouTrackException
+
+DEFAULT_WORKERS = 4
+
+_rate_limiters = dict([])
+_rate_limiters_lock = threading.Lock()
+
+
+class RateLimiter(object):
+    """Lets at most `rate` requests per second start against one host."""
+
+    def __init__(self, rate):
+        self._interval = 1.0 / rate
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.time()
+            start = max(now, self._next)
+            self._next = start + self._interval
+        if start > now:
+            time.sleep(start - now)
+
+
+def get_rate_limiter(url, rate):
+    """Returns the limiter shared by all uploaders talking to url's host."""
+    host = urlparse.urlparse(url).netloc
+    with _rate_limiters_lock:
+        if host not in _rate_limiters:
+            _rate_limiters[host] = RateLimiter(rate)
+        return _rate_limiters[host]
+
+
+def is_transient(e):
+    if isinstance(e, urllib2.HTTPError):
+        return e.code == 429 or e.code >= 500
+    if isinstance(e, YouTrackException):
+        status = getattr(e.response, 'status', None)
+        return status == 429 or (status is not None and status >= 500)
+    return isinstance(e, (urllib2.URLError, httplib.HTTPException,
+                          socket.error))
+
+
+def import_from_attachment(target, issue_id, attachment):
+    """Same as Connection.createAttachmentFromAttachment, but lets errors
+    through so that the uploader can retry them.
+    """
+    content = attachment.getContent()
+    try:
+        content_length = None
+        if 'content-length' in content.headers.dict:
+            content_length = int(content.headers.dict['content-length'])
+        return target.importAttachment(
+            issue_id, attachment.name, content, attachment.authorLogin,
+            contentLength=content_length,
+            contentType=content.info().type,
+            created=getattr(attachment, 'created', None),
+            group=getattr(attachment, 'group', ''))
+    finally:
+        content.close()
+
+
+class _Task(object):
+    def __init__(self, issue_id, name, upload, size, on_done):
+        self.issue_id = issue_id
+        self.name = name
+        self.upload = upload
+        self.size = size
+        self.on_done = on_done
+        self.error = None
+
+
+class AttachmentUploader(object):
+    """Uploads attachments to YouTrack in a pool of worker threads.
+
+    `upload` callables passed to submit() run in the workers and may be
+    called several times, so they have to (re)open their content on every
+    call. They must only use urllib2 based methods of the target connection
+    (importAttachment, createAttachment with `created` set): the httplib2
+    client behind the other methods can't be shared between threads.
+    `on_done(ok)` callbacks run in the thread that calls submit() or join().
+
+    The queue is bounded, so submit() blocks while all workers are busy and
+    `workers` uploads are already waiting.
+    """
+
+    def __init__(self, target_url, workers=DEFAULT_WORKERS, rate=None,
+                 max_attempts=5, backoff=2.0, max_backoff=60.0):
+        self.workers = max(1, workers)
+        self._limiter = get_rate_limiter(target_url, rate) if rate else None
+        self._max_attempts = max_attempts
+        self._backoff = backoff
+        self._max_backoff = max_backoff
+        self._tasks = Queue.Queue(self.workers)
+        self._done = Queue.Queue()
+        self._threads = []
+        self._started = None
+        self._lock = threading.Lock()
+        self.submitted = 0
+        self.uploaded = 0
+        self.failed = 0
+        self.retries = 0
+        self.bytes = 0
+
+    def submit(self, issue_id, name, upload, size=None, on_done=None):
+        if self._started is None:
+            self._start()
+        self._run_callbacks()
+        if isinstance(name, unicode):
+            name = name.encode('utf-8')
+        self.submitted += 1
+        if not self.submitted % 100:
+            print(self.summary())
+        self._tasks.put(_Task(issue_id, name, upload, size, on_done))
+
+    def join(self):
+        """Waits for all submitted uploads and stops the workers."""
+        if self._started is None:
+            return
+        for _ in self._threads:
+            self._tasks.put(None)
+        for t in self._threads:
+            t.join()
+        self._threads = []
+        self._run_callbacks()
+        print(self.summary())
+        self._started = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.join()
+
+    def summary(self):
+        elapsed = time.time() - self._started if self._started else 0
+        msg = "Attachments: %d uploaded, %d failed, %d retries" % (
+            self.uploaded, self.failed, self.retries)
+        if self.bytes:
+            msg += ", %.1f MB" % (self.bytes / 1048576.0)
+            if elapsed:
+                msg += " (%.1f MB/s)" % (self.bytes / 1048576.0 / elapsed)
+        if elapsed:
+            msg += " in %.1f s" % elapsed
+        return msg
+
+    def _start(self):
+        self._started = time.time()
+        for _ in range(self.workers):
+            t = threading.Thread(target=self._work)
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def _run_callbacks(self):
+        while True:
+            try:
+                task = self._done.get_nowait()
+            except Queue.Empty:
+                return
+            if task.error is None:
+                self.uploaded += 1
+                if task.size:
+                    self.bytes += task.size
+            else:
+                self.failed += 1
+                print("Failed to import attachment [ %s ] for issue [ %s ]: %s"
+                      % (task.name, task.issue_id, task.error))
+            if task.on_done is not None:
+                try:
+                    task.on_done(task.error is None)
+                except Exception:
+                    traceback.print_exc(file=sys.stdout)
+
+    def _work(self):
+        while True:
+            task = self._tasks.get()
+            if task is None:
+                return
+            try:
+                self._upload(task)
+            except Exception as e:
+                task.error = e
+            self._done.put(task)
+
+    def _upload(self, task):
+        attempt = 0
+        while True:
+            attempt += 1
+            if self._limiter is not None:
+                self._limiter.wait()
+            try:
+                task.upload()
+                return
+            except Exception as e:
+                if attempt >= self._max_attempts or not is_transient(e):
+                    task.error = e
+                    return
+                with self._lock:
+                    self.retries += 1
+                delay = min(self._max_backoff,
+                            self._backoff * 2 ** (attempt - 1))
+                delay = random.uniform(delay / 2, delay)
+                print("Can't import attachment [ %s ] for issue [ %s ]: %s. "
+                      "Retry in %.1f s." % (task.name, task.issue_id, e, delay))
+                time.sleep(delay)
@@ -0,0 +1,45 @@
+import json
+
+from youtrack import YouTrackException
+
+# YouTrack instances that don't have the /api/commands endpoint
+_no_batch_support = set([])
+
+
+def execute_command_for_issues(target, issue_ids, command,
+                               disable_notifications=False, max_count=100):
+    """Applies the same command to many issues.
+
+    Issues are sent in chunks of max_count through the /api/commands
+    endpoint. If the server doesn't support it or rejects a chunk, the
+    command is executed for every issue of the chunk separately.
+    Returns ids of the issues the command failed for.
+    """
+    failed = []
+    issue_ids = list(issue_ids)
+    for i in range(0, len(issue_ids), max_count):
+        chunk = issue_ids[i:i + max_count]
+        if target.url not in _no_batch_support:
+            try:
+                _post_command(target, chunk, command, disable_notifications)
+                continue
+            except YouTrackException as e:
+                if e.response.status in (404, 405):
+                    _no_batch_support.add(target.url)
+        for issue_id in chunk:
+            try:
+                target.executeCommand(
+                    issue_id, command,
+                    disable_notifications=disable_notifications)
+            except YouTrackException:
+                failed.append(issue_id)
+    return failed
+
+
+def _post_command(target, issue_ids, command, disable_notifications):
+    body = dict(query=command,
+                issues=[dict(idReadable=issue_id) for issue_id in issue_ids])
+    if disable_notifications:
+        body['silent'] = True
+    target._req('POST', target.url + '/api/commands',
+                body=json.dumps(body), content_type='application/json')
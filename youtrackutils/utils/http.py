@@ -0,0 +1,121 @@
+import httplib
+import socket
+import threading
+import urllib2
+import urlparse
+from StringIO import StringIO
+
+_REDIRECTS = (301, 302, 303, 307, 308)
+
+
+class ConnectionPool(object):
+    """Keep-alive HTTP(S) connections, one per host in every thread.
+
+    open() returns as soon as the headers are received, so the body can be
+    streamed to its consumer. The connection goes back to the pool when the
+    body has been read to the end; closing a response earlier drops the
+    connection. Responses with error codes are raised as urllib2.HTTPError,
+    so callers can handle them the same way as urllib2 errors.
+    """
+
+    def __init__(self, timeout=60, max_redirects=5):
+        self._timeout = timeout
+        self._max_redirects = max_redirects
+        self._local = threading.local()
+
+    def open(self, url, headers=None):
+        headers = headers or {}
+        for _ in range(self._max_redirects + 1):
+            response = self._request(url, headers)
+            if response.status not in _REDIRECTS:
+                break
+            location = response.getheader('location')
+            response.read()
+            response.close()
+            url = urlparse.urljoin(url, location)
+        if response.status >= 300:
+            body = response.read()
+            response.close()
+            raise urllib2.HTTPError(url, response.status, response.reason,
+                                    response.msg, StringIO(body))
+        return response
+
+    def _request(self, url, headers):
+        parts = urlparse.urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        connection = self._get_idle().pop(key, None)
+        reused = connection is not None
+        while True:
+            if connection is None:
+                connection = self._connect(parts.scheme, parts.netloc)
+            try:
+                connection.request('GET', path, headers=headers)
+                return _Response(self, key, connection,
+                                 connection.getresponse())
+            except (httplib.BadStatusLine, socket.error):
+                connection.close()
+                # The server may have closed an idle connection, only
+                # a fresh one is worth a retry
+                if not reused:
+                    raise
+                connection = None
+                reused = False
+
+    def _connect(self, scheme, netloc):
+        if scheme == 'https':
+            return httplib.HTTPSConnection(netloc, timeout=self._timeout)
+        return httplib.HTTPConnection(netloc, timeout=self._timeout)
+
+    def _get_idle(self):
+        if not hasattr(self._local, 'idle'):
+            self._local.idle = dict([])
+        return self._local.idle
+
+    def _release(self, key, connection):
+        idle = self._get_idle()
+        if key in idle:
+            idle[key].close()
+        idle[key] = connection
+
+
+class _Response(object):
+    def __init__(self, pool, key, connection, response):
+        self._pool = pool
+        self._key = key
+        self._connection = connection
+        self._response = response
+        self.status = response.status
+        self.reason = response.reason
+        self.msg = response.msg
+        self.headers = response.msg
+
+    def info(self):
+        return self.msg
+
+    def getheader(self, name, default=None):
+        return self._response.getheader(name, default)
+
+    def read(self, amt=None):
+        data = self._response.read(amt)
+        if self._response.isclosed():
+            self._done()
+        return data
+
+    def close(self):
+        if self._connection is None:
+            return
+        if self._response.isclosed():
+            self._done()
+        else:
+            # the rest of the body would be read by the next request
+            self._response.close()
+            self._connection.close()
+            self._connection = None
+
+    def _done(self):
+        if self._connection is not None:
+            self._pool._release(self._key, self._connection)
+            self._connection = None
@@ -0,0 +1,43 @@
+import sqlite3
+import threading
+
+
+class ResponseCache(object):
+    """Bodies of GET responses and their validators kept in an SQLite file.
+
+    Entries are stored with the ETag and Last-Modified headers of the
+    response, so that a later run can make conditional requests and reuse
+    the body when the server answers 304 Not Modified. The Link header is
+    kept too, as paginated APIs put the next page there. A cache can be
+    shared between threads.
+    """
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS response (
+                url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT,
+                link TEXT, body BLOB);
+        """)
+
+    def get(self, url):
+        """Returns (etag, last_modified, link, body) of the url or None."""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT etag, last_modified, link, body FROM response "
+                "WHERE url = ?", (url,)).fetchone()
+        if row is None:
+            return None
+        return row[0], row[1], row[2], str(row[3])
+
+    def put(self, url, etag, last_modified, link, body):
+        with self._lock:
+            with self._db:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO response VALUES (?, ?, ?, ?, ?)",
+                    (url, etag, last_modified, link, sqlite3.Binary(body)))
+
+    def close(self):
+        with self._lock:
+            self._db.close()
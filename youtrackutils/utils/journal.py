@@ -0,0 +1,114 @@
+import os
+import sqlite3
+import threading
+
+
+def journal_path(name):
+    return os.path.join(os.getcwd(), name + '.journal')
+
+
+def _synchronized(method):
+    def wrapper(self, *args):
+        with self._lock:
+            return method(self, *args)
+    return wrapper
+
+
+def _to_unicode(value):
+    if isinstance(value, str):
+        return value.decode('utf-8')
+    return unicode(value)
+
+
+class Journal(object):
+    """Checkpoints of an import run kept in an SQLite file.
+
+    Records finished phases, the position an import reached in every
+    project and keys of transferred items (attachments, links, ...), so
+    that an interrupted run can be resumed. Unless `resume` is set the
+    journal of the previous run is discarded.
+
+    Item keys of a kind are loaded into memory on the first lookup, so
+    has() doesn't query the database. A journal can be shared between
+    threads.
+    """
+
+    def __init__(self, path, resume=False):
+        if not resume and os.path.exists(path):
+            os.remove(path)
+        self.resume = resume
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS phase (name TEXT PRIMARY KEY);
+            CREATE TABLE IF NOT EXISTS position (
+                project TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS item (
+                kind TEXT, key TEXT, PRIMARY KEY (kind, key));
+        """)
+        self._items = dict([])
+
+    @_synchronized
+    def is_done(self, phase):
+        cursor = self._db.execute(
+            "SELECT 1 FROM phase WHERE name = ?", (_to_unicode(phase),))
+        return cursor.fetchone() is not None
+
+    @_synchronized
+    def done(self, phase):
+        with self._db:
+            self._db.execute("INSERT OR IGNORE INTO phase VALUES (?)",
+                             (_to_unicode(phase),))
+
+    @_synchronized
+    def get_position(self, project_id, default=None):
+        cursor = self._db.execute(
+            "SELECT value FROM position WHERE project = ?",
+            (_to_unicode(project_id),))
+        row = cursor.fetchone()
+        return default if row is None else row[0]
+
+    @_synchronized
+    def set_position(self, project_id, value):
+        with self._db:
+            self._db.execute("INSERT OR REPLACE INTO position VALUES (?, ?)",
+                             (_to_unicode(project_id), _to_unicode(value)))
+
+    @_synchronized
+    def has(self, kind, key):
+        return _to_unicode(key) in self._get_items(kind)
+
+    @_synchronized
+    def add(self, kind, key):
+        key = _to_unicode(key)
+        items = self._get_items(kind)
+        if key in items:
+            return
+        with self._db:
+            self._db.execute("INSERT OR IGNORE INTO item VALUES (?, ?)",
+                             (kind, key))
+        items.add(key)
+
+    @_synchronized
+    def add_all(self, kind, keys):
+        items = self._get_items(kind)
+        keys = set([_to_unicode(key) for key in keys]) - items
+        with self._db:
+            self._db.executemany("INSERT OR IGNORE INTO item VALUES (?, ?)",
+                                 [(kind, key) for key in keys])
+        items.update(keys)
+
+    @_synchronized
+    def close(self):
+        self._db.close()
+
+    def _get_items(self, kind):
+        if kind not in self._items:
+            cursor = self._db.execute(
+                "SELECT key FROM item WHERE kind = ?", (kind,))
+            self._items[kind] = set([row[0] for row in cursor])
+        return self._items[kind]
+
+
+def link_key(link):
+    return u'%s\n%s\n%s' % (link.typeName, link.source, link.target)
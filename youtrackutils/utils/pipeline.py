@@ -0,0 +1,145 @@
+import Queue
+import sys
+import threading
+import time
+
+_END = object()
+
+
+class PipelineError(Exception):
+    pass
+
+
+class _Stage(object):
+    def __init__(self, name, process):
+        self.name = name
+        self.process = process
+        self.items = 0
+        self.busy = 0.0
+
+
+class Pipeline(object):
+    """Runs the stages of an import concurrently.
+
+    The source iterable is read in a thread of its own and each item is
+    passed through the stages in order; whatever a stage returns becomes
+    the input of the next one. Stages are connected by queues of
+    `queue_size` items, so a slow stage holds back the ones before it.
+    Every stage but the last has its own thread, the last one runs in the
+    thread that calls run(). As a source connection usually can't be
+    shared between threads, only the source iterable should read from it.
+
+    If a stage fails the other ones stop after their current item and
+    run() re-raises the error.
+    """
+
+    def __init__(self, source, queue_size=2):
+        self._source = _Stage('read', None)
+        self._iterable = source
+        self._stages = []
+        self._queue_size = queue_size
+        self._error = None
+        self._stopped = threading.Event()
+        self._started = None
+        self._finished = None
+
+    def add_stage(self, name, process):
+        self._stages.append(_Stage(name, process))
+        return self
+
+    def run(self):
+        if not self._stages:
+            raise PipelineError("Pipeline has no stages")
+        self._started = time.time()
+        queues = [Queue.Queue(self._queue_size) for _ in self._stages]
+        threads = [threading.Thread(target=self._read, args=(queues[0],))]
+        for i, stage in enumerate(self._stages[:-1]):
+            threads.append(threading.Thread(
+                target=self._work, args=(stage, queues[i], queues[i + 1])))
+        for t in threads:
+            t.daemon = True
+            t.start()
+        self._work(self._stages[-1], queues[-1], None)
+        for t in threads:
+            t.join()
+        self._finished = time.time()
+        if self._error is not None:
+            raise self._error[0], self._error[1], self._error[2]
+
+    def summary(self):
+        end = self._finished or time.time()
+        elapsed = end - self._started if self._started else 0
+        lines = ["Pipeline: %.1f s" % elapsed]
+        for stage in [self._source] + self._stages:
+            utilisation = 100.0 * stage.busy / elapsed if elapsed else 0
+            lines.append("  %-10s %6d items, busy %.1f s (%d%%)" % (
+                stage.name, stage.items, stage.busy, utilisation))
+        return "\n".join(lines)
+
+    def _read(self, output):
+        items = iter(self._iterable)
+        try:
+            while not self._stopped.is_set():
+                start = time.time()
+                try:
+                    item = next(items)
+                except StopIteration:
+                    break
+                finally:
+                    self._source.busy += time.time() - start
+                self._source.items += 1
+                self._put(output, item)
+        except BaseException:
+            self._fail()
+        self._put(output, _END)
+
+    def _work(self, stage, input, output):
+        try:
+            while True:
+                item = self._get(input)
+                if item is _END:
+                    break
+                start = time.time()
+                try:
+                    result = stage.process(item)
+                finally:
+                    stage.busy += time.time() - start
+                stage.items += 1
+                if output is not None:
+                    self._put(output, result)
+        except BaseException:
+            self._fail()
+        if output is not None:
+            self._put(output, _END)
+
+    def _fail(self):
+        if self._error is None:
+            self._error = sys.exc_info()
+        self._stopped.set()
+
+    def _put(self, queue, item):
+        while True:
+            if self._stopped.is_set() and item is not _END:
+                return
+            try:
+                queue.put(item, timeout=0.1)
+                return
+            except Queue.Full:
+                if item is _END and self._stopped.is_set():
+                    # nobody reads the queue after a failure, make room
+                    try:
+                        queue.get_nowait()
+                    except Queue.Empty:
+                        pass
+
+    def _get(self, queue):
+        while True:
+            try:
+                item = queue.get(timeout=0.1)
+            except Queue.Empty:
+                if self._stopped.is_set():
+                    return _END
+                continue
+            if self._stopped.is_set():
+                return _END
+            return item
@@ -0,0 +1,128 @@
+from xml.dom import Node
+
+from youtrack import YouTrackException, User
+from youtrack.connection import urlquote
+
+
+def _value_name(value):
+    if isinstance(value, basestring):
+        return value.lower()
+    if isinstance(value, User):
+        return value.login.lower()
+    return value.name.lower()
+
+
+class TargetSchema(object):
+    """In-memory model of custom fields and bundles of a YouTrack instance.
+
+    Field names, fields attached to a project and values of a bundle are
+    loaded with one request the first time they are needed and updated as
+    the importer creates new ones, so checks for known fields and values
+    don't go to the server. New bundle values are collected and added by
+    flush(), which has to be called before issues using them are imported.
+    """
+
+    def __init__(self, target):
+        self._target = target
+        self._field_names = None
+        self._project_fields = dict([])
+        self._bundles = dict([])
+        self._pending = []
+
+    def has_field(self, name):
+        if self._field_names is None:
+            xml = self._target._get('/admin/customfield/field')
+            self._field_names = set([
+                e.getAttribute('name').lower()
+                for e in xml.documentElement.childNodes
+                if e.nodeType == Node.ELEMENT_NODE])
+        return name.lower() in self._field_names
+
+    def create_field(self, name, field_type):
+        self._target.createCustomFieldDetailed(
+            name, field_type, False, True, False, {})
+        self._field_names.add(name.lower())
+
+    def get_project_field(self, project_id, name):
+        """Returns the project custom field or None if it isn't attached."""
+        fields = self._get_project_fields(project_id)
+        key = name.lower()
+        if key not in fields:
+            return None
+        if fields[key] is None:
+            fields[key] = self._target.getProjectCustomField(project_id, name)
+        return fields[key]
+
+    def attach_field(self, project_id, name, empty_text, params=None):
+        self._target.createProjectCustomFieldDetailed(
+            project_id, name, empty_text, params)
+        self._get_project_fields(project_id)[name.lower()] = None
+
+    def create_bundle(self, field_type, name):
+        bundle = self._new_bundle(field_type, name)
+        try:
+            self._target.createBundle(bundle)
+        except YouTrackException as e:
+            if e.response.status != 409:
+                raise e
+            print("Bundle with name [ %s ] already exists" % name)
+            return
+        field_type = self._target.get_field_type(field_type)
+        self._bundles[(field_type, name)] = (bundle, set([]))
+
+    def add_bundle_value(self, field_type, bundle_name, value):
+        """Queues the value to be added to the bundle unless it's known."""
+        bundle, values = self._get_bundle(field_type, bundle_name)
+        key = _value_name(value)
+        if key not in values:
+            values.add(key)
+            self._pending.append((bundle, value))
+
+    def flush(self):
+        pending, self._pending = self._pending, []
+        for bundle, value in pending:
+            try:
+                self._target.addValueToBundle(bundle, value)
+            except YouTrackException as e:
+                if e.response.status != 409:
+                    print(e)
+
+    def _get_project_fields(self, project_id):
+        if project_id not in self._project_fields:
+            names = self._get_names(
+                '/admin/project/%s/customfield' % urlquote(project_id),
+                'projectCustomField', 'name')
+            self._project_fields[project_id] = dict(
+                [(name.lower(), None) for name in names])
+        return self._project_fields[project_id]
+
+    def _get_bundle(self, field_type, name):
+        field_type = self._target.get_field_type(field_type)
+        if (field_type, name) not in self._bundles:
+            bundle = self._new_bundle(field_type, name)
+            url = '/admin/customfield/%s/%s' % (
+                self._target.bundle_paths[field_type],
+                urlquote(name.encode('utf-8')))
+            if field_type == 'user':
+                names = self._get_names(url, 'user', 'login')
+            else:
+                # get_field_type() isn't the element tag for all bundles,
+                # values of enum bundles are <value> elements
+                names = self._get_names(url, bundle._element_tag_name, None)
+            self._bundles[(field_type, name)] = (
+                bundle, set([n.lower() for n in names]))
+        return self._bundles[(field_type, name)]
+
+    def _new_bundle(self, field_type, name):
+        field_type = self._target.get_field_type(field_type)
+        bundle = self._target.bundle_types[field_type](None, None)
+        bundle.name = name
+        return bundle
+
+    def _get_names(self, url, tag, attribute):
+        xml = self._target._get(url)
+        if attribute is None:
+            return [e.firstChild.data if e.firstChild else u''
+                    for e in xml.getElementsByTagName(tag)]
+        return [e.getAttribute(attribute)
+                for e in xml.getElementsByTagName(tag)]
@@ -0,0 +1,27 @@
+class UserCache(object):
+    """Resolves source tracker user ids to user objects.
+
+    All users are preloaded with a single query when the cache is created;
+    ids missing from the preload are resolved one by one and remembered.
+    """
+
+    def __init__(self, load_all, load_one):
+        self._load_one = load_one
+        self._users = dict(load_all())
+        self.preloaded = len(self._users)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id):
+        try:
+            user = self._users[user_id]
+            self.hits += 1
+        except KeyError:
+            self.misses += 1
+            user = self._load_one(user_id)
+            self._users[user_id] = user
+        return user
+
+    def summary(self):
+        return "User cache: %d users preloaded, %d hits, %d misses" % (
+            self.preloaded, self.hits, self.misses)
@@ -0,0 +1,22 @@
+def workitem_key(workitem):
+    return (workitem.date, workitem.duration, workitem.authorLogin,
+            getattr(workitem, 'description', None))
+
+
+def get_new_workitems(source, target, source_issue_id, target_issue_id):
+    """Returns workitems of the source issue the target issue doesn't have.
+
+    Target workitems are only requested if the source issue has any.
+    """
+    workitems = source.getWorkItems(source_issue_id)
+    if not workitems:
+        return []
+    existing = set([workitem_key(w)
+                    for w in target.getWorkItems(target_issue_id) or []])
+    return [w for w in workitems if workitem_key(w) not in existing]
+
+
+def get_authors(workitems, known_authors=()):
+    """Returns logins of workitem authors that aren't in known_authors."""
+    return set([w.authorLogin for w in workitems
+                if w.authorLogin not in known_authors])
@@ -14,6 +14,15 @@ from youtrack.sync.links import LinkImporter
 import re
 import getopt
 import datetime
+import copy
+import hashlib
+import threading
+from xml.dom import minidom
+from multiprocessing.pool import ThreadPool
+from youtrackutils.utils.attachments import AttachmentUploader, \
+    DEFAULT_WORKERS, import_from_attachment
+from youtrackutils.utils.journal import Journal, journal_path, link_key
+from youtrackutils.utils.workitems import get_new_workitems, get_authors
 
 convert_period_values = False
 days_in_a_week = 5
@@ -41,7 +50,12 @@ Options:
     -h,  Show this help and exit
     -a,  Import attachments only
     -n,  Create new issues instead of importing them
+    -i,  Incremental sync: import only issues updated since the previous
+         run with this option (can't be used with -n). Time of the last
+         change in every project is kept in youtrack2youtrack_sync.journal
     -c,  Add new comments to target issues
+    -C,  Same as -c, but add comments with one issue import per chunk of
+         issues instead of one command per comment
     -f,  Sync custom field values
     -S,  Sync tags (tags will be created on behalf of logged in user)
     -r,  Replace old attachments with new ones (remove and re-import)
@@ -49,7 +63,14 @@ Options:
     -w,  Covert period values (used as workaround for JT-19362)
     -s TIME_SETTINGS,
          Time Tracking settings in format "days_in_a_week:hours_in_a_day"
-""" % os.path.basename(sys.argv[0]))
+    -j WORKERS,
+         Number of attachments to upload in parallel (default %d)
+    -R RATE,
+         Max number of attachment uploads per second (not limited by default)
+    --resume
+         Continue an interrupted import skipping the work that was already
+         done (uses the journal file in the current directory)
+""" % (os.path.basename(sys.argv[0]), DEFAULT_WORKERS))
 
 
 def main():
@@ -59,7 +80,8 @@ def main():
     attachments_only = False
     try:
         params = {}
-        opts, args = getopt.getopt(sys.argv[1:], 'ht:z:u:p:U:P:anrcdfpws:T:S')
+        opts, args = getopt.getopt(sys.argv[1:], 'ht:z:u:p:U:P:anircCdfpws:T:Sj:R:',
+                                   ['resume'])
         source_token = None
         target_token = None
 
@@ -80,12 +102,17 @@ def main():
                 params['replace_attachments'] = True
             elif opt == '-c':
                 params['add_new_comments'] = True
+            elif opt == '-C':
+                params['add_new_comments'] = True
+                params['import_comments'] = True
             elif opt == '-f':
                 params['sync_custom_fields'] = True
             elif opt == '-d':
                 params['enable_user_caching'] = False
             elif opt == '-n':
                 params['create_new_issues'] = True
+            elif opt == '-i':
+                params['incremental'] = True
             elif opt == '-S':
                 params['sync_tags'] = True
             elif opt == '-s':
@@ -109,16 +136,30 @@ def main():
                 target_login = val
             elif opt == '-P':
                 target_password = val
-        (source_url, target_url) = args[:2]
-        project_ids = args[2:]
+            elif opt == '-j':
+                params['attachment_workers'] = int(val)
+            elif opt == '-R':
+                params['attachment_rate'] = float(val)
+            elif opt == '--resume':
+                params['resume'] = True
     except getopt.GetoptError as e:
         print(e)
         usage()
         sys.exit(1)
+    except ValueError:
+        print('Bad arguments')
+        usage()
+        sys.exit(1)
+    try:
+        (source_url, target_url) = args[:2]
+        project_ids = args[2:]
     except ValueError:
         print('Not enough arguments')
         usage()
         sys.exit(1)
+    if params.get('incremental') and params.get('create_new_issues'):
+        print("Options -i and -n can't be used together")
+        sys.exit(1)
     if attachments_only:
         import_attachments_only(source_url, source_login, source_password,
                                 target_url, target_login, target_password,
@@ -129,6 +170,12 @@ def main():
                           project_ids, '', source_token, target_token, params=params)
 
 
+def connect(url, login, password, token=None):
+    if token is None:
+        return Connection(url, login, password)
+    return Connection(url, token=token)
+
+
 def create_bundle_from_bundle(source, target, bundle_name, bundle_type, user_importer):
     source_bundle = source.getBundle(bundle_type, bundle_name)
     # here we should check whether target YT has bundle with same name. But actually, to check tis, we should
@@ -272,6 +319,248 @@ def create_issues(target, issues, last_issue_number):
     return last_issue_number
 
 
+def get_last_update(source, project_id):
+    issues = source.getIssues(project_id, 'sort by: updated desc', 0, 1)
+    if not issues:
+        return None
+    return int(issues[0].updated)
+
+
+def updated_since_query(query, since):
+    # Dates in queries are in the time zone of the user, starting a day
+    # earlier covers any difference to UTC
+    day = datetime.datetime.utcfromtimestamp(since / 1000) - \
+        datetime.timedelta(days=1)
+    return ('%s updated: %s .. Today' % (query, day.strftime('%Y-%m-%d'))).strip()
+
+
+def add_existing_link_ends(target, link_importer):
+    """Makes link_importer accept links to issues that already are in target.
+
+    Used instead of addAvailableIssuesFrom() in incremental mode, so that
+    only the issues links point to are requested rather than all of them.
+    """
+    checked = set(link_importer.created_issue_ids)
+    for link in link_importer.links:
+        for issue_id in (link.source, link.target):
+            if issue_id in checked:
+                continue
+            checked.add(issue_id)
+            try:
+                link_importer.addAvailableIssue(target.getIssue(issue_id))
+            except youtrack.YouTrackException:
+                pass
+
+
+def get_target_issues(target, project_id, issues):
+    """Returns target issues with ids of the given ones by id.
+
+    Issues are requested with one query, those missing from the result
+    have to be requested one by one.
+    """
+    if not issues:
+        return dict([])
+    query = 'issue id: ' + ', '.join([issue.id for issue in issues])
+    try:
+        return dict([(issue.id, issue)
+                     for issue in target.getIssues(project_id, query, 0, len(issues))])
+    except youtrack.YouTrackException as e:
+        print("Cannot get target issues by query, requesting them one by one")
+        print(e)
+        return dict([])
+
+
+def get_field_commands(issue, target_issue, source_fields, target_fields):
+    """Returns commands that set custom fields of target_issue to values
+    of the source issue.
+
+    source_fields are project custom fields of the source and target_fields
+    ones of the target by lower case name. Fields the target project
+    doesn't have are skipped, commands setting them would fail.
+    """
+    commands = []
+    for pcf in source_fields:
+        target_pcf = target_fields.get(pcf.name.lower())
+        if target_pcf is None:
+            continue
+        target_empty_text = getattr(target_pcf, 'emptyText', None)
+        target_cf_value = None
+        if pcf.name in target_issue:
+            target_cf_value = target_issue[pcf.name]
+            if isinstance(target_cf_value, (list, tuple)):
+                target_cf_value = set(target_cf_value)
+            elif target_cf_value == target_empty_text:
+                target_cf_value = None
+        source_cf_value = None
+        if pcf.name in issue:
+            source_cf_value = issue[pcf.name]
+            if isinstance(source_cf_value, (list, tuple)):
+                source_cf_value = set(source_cf_value)
+            elif source_cf_value == pcf.emptyText:
+                source_cf_value = None
+        if source_cf_value == target_cf_value:
+            continue
+        if isinstance(source_cf_value, set) or isinstance(target_cf_value, set):
+            if source_cf_value is None:
+                source_cf_value = set([])
+            elif not isinstance(source_cf_value, set):
+                source_cf_value = set([source_cf_value])
+            if target_cf_value is None:
+                target_cf_value = set([])
+            elif not isinstance(target_cf_value, set):
+                target_cf_value = set([target_cf_value])
+            for v in target_cf_value:
+                if v not in source_cf_value:
+                    commands.append('remove %s %s' % (pcf.name, v))
+            for v in source_cf_value:
+                if v not in target_cf_value:
+                    commands.append('add %s %s' % (pcf.name, v))
+        else:
+            if source_cf_value is None:
+                source_cf_value = target_empty_text
+                if source_cf_value is None:
+                    continue
+            if pcf.type.lower() == 'date':
+                m = re.match(r'(\d{10})(?:\d{3})?', str(source_cf_value))
+                if m:
+                    source_cf_value = datetime.datetime.fromtimestamp(
+                        int(m.group(1))).strftime('%Y-%m-%d')
+            elif pcf.type.lower() == 'period':
+                source_cf_value = '%sm' % source_cf_value
+            commands.append('%s %s' % (pcf.name, source_cf_value))
+    return commands
+
+
+def comment_key(comment, with_time=True):
+    text = getattr(comment, 'text', '') or ''
+    key = u'%s\n%s' % (comment.author, text)
+    if with_time:
+        key = u'%s\n%s' % (comment.created, key)
+    return hashlib.sha1(key.encode('utf-8')).digest()
+
+
+def get_new_comments(issue, target_issue):
+    """Returns comments of issue that target_issue doesn't have.
+
+    Comments are matched by author, creation time and text. Comments
+    added by a command get the time of the command, so comments left
+    unmatched are then matched by author and text only.
+    """
+    target_keys = dict([])
+    target_texts = dict([])
+    for c in target_issue.getComments():
+        key = comment_key(c)
+        target_keys[key] = target_keys.get(key, 0) + 1
+        key = comment_key(c, False)
+        target_texts[key] = target_texts.get(key, 0) + 1
+    unmatched = []
+    for c in issue.getComments():
+        key = comment_key(c)
+        if target_keys.get(key):
+            target_keys[key] -= 1
+            target_texts[comment_key(c, False)] -= 1
+        else:
+            unmatched.append(c)
+    new_comments = []
+    for c in unmatched:
+        key = comment_key(c, False)
+        if target_texts.get(key):
+            target_texts[key] -= 1
+        else:
+            new_comments.append(c)
+    return new_comments
+
+
+def add_comments(target, issue_id, comments):
+    for c in comments:
+        group = None
+        if hasattr(c, 'permittedGroup'):
+            group = c.permittedGroup
+        try:
+            target.executeCommand(issue_id, 'comment', c.text, group, c.author,
+                                  disable_notifications=True)
+        except youtrack.YouTrackException as e:
+            print('Cannot add comment to issue')
+            print(e)
+
+
+def get_failed_imports(result, issues):
+    """Returns issues that the importIssues() result doesn't report as
+    imported, or None if the result can't be read.
+    """
+    try:
+        items = minidom.parseString(result).getElementsByTagName('item')
+    except Exception:
+        return None
+    imported = set([item.getAttribute('id') for item in items
+                    if item.getAttribute('imported').lower() == 'true'])
+    return [issue for issue in issues
+            if str(issue.numberInProject) not in imported]
+
+
+def import_comments(target, project_id, assignee_group, issues):
+    """Adds new comments by importing issues that have only those.
+
+    Falls back to adding comments by commands to issues the import fails
+    for.
+    """
+    try:
+        result = target.importIssues(project_id, assignee_group, issues)
+    except youtrack.YouTrackException as e:
+        print('Cannot import comments, adding them by commands')
+        print(e)
+        failed = issues
+    else:
+        print(result)
+        failed = get_failed_imports(result, issues)
+        if failed is None:
+            # Issues may have been imported one by one by the library,
+            # see which comments the target still lacks
+            print('Cannot read import result, checking comments of issues')
+            target_issues = get_target_issues(target, project_id, issues)
+            failed = []
+            for issue in issues:
+                target_issue = target_issues.get(issue.id)
+                if target_issue is None:
+                    try:
+                        target_issue = target.getIssue(issue.id)
+                    except youtrack.YouTrackException as e:
+                        print('Cannot get target issue')
+                        print(e)
+                        continue
+                issue = copy.copy(issue)
+                issue.comments = get_new_comments(issue, target_issue)
+                if issue.comments:
+                    failed.append(issue)
+        elif failed:
+            print('Comments of %d issues were not imported, adding them by '
+                  'commands' % len(failed))
+    for issue in failed:
+        add_comments(target, issue.id, issue.comments)
+
+
+def execute_field_commands(target, issue_id, commands, failed_commands):
+    """Executes all commands as one, or one by one if that fails."""
+    if not commands:
+        return
+    if len(commands) > 1:
+        try:
+            target.executeCommand(issue_id, ' '.join(commands), disable_notifications=True)
+            return
+        except youtrack.YouTrackException as e:
+            print('Cannot sync custom fields of issue %s with one command: %s' % (issue_id, e))
+    for command in commands:
+        try:
+            target.executeCommand(issue_id, command, disable_notifications=True)
+        except youtrack.YouTrackException as e:
+            if e.response.status == 412 and e.response.reason.find('Precondition Failed') > -1:
+                print('WARN: Some workflow blocks following command: %s' % command)
+                failed_commands.append((issue_id, command))
+            else:
+                print('Failed to execute command for issue #%s: %s' % (issue_id, command))
+                print(e)
+
+
 def youtrack2youtrack(source_url, source_login, source_password, target_url, target_login, target_password,
                       project_ids, query='', source_token=None, target_token=None, params=None):
     if not len(project_ids):
@@ -285,16 +574,32 @@ def youtrack2youtrack(source_url, source_login, source_password, target_url, tar
     target = Connection(target_url, target_login, target_password) if (target_token is None) else Connection(target_url,
                                                                                                              token=target_token)
     # , proxy_info = httplib2.ProxyInfo(socks.PROXY_TYPE_HTTP, 'localhost', 8888)
-
-    print("Import issue link types")
-    for ilt in source.getIssueLinkTypes():
-        try:
-            print(target.createIssueLinkType(ilt))
-        except youtrack.YouTrackException as e:
-            print(e.message)
+    journal = Journal(journal_path('youtrack2youtrack'), params.get('resume'))
+    # Time of the last change in every project the previous incremental run saw
+    sync_state = None
+    if params.get('incremental'):
+        sync_state = Journal(journal_path('youtrack2youtrack_sync'), True)
+    last_updates = dict([])
+
+    if not journal.is_done('link_types'):
+        print("Import issue link types")
+        for ilt in source.getIssueLinkTypes():
+            try:
+                print(target.createIssueLinkType(ilt))
+            except youtrack.YouTrackException as e:
+                print(e.message)
+        journal.done('link_types')
 
     user_importer = UserImporter(source, target, caching_users=params.get('enable_user_caching', True))
+    uploader = AttachmentUploader(
+        target_url,
+        workers=params.get('attachment_workers', DEFAULT_WORKERS),
+        rate=params.get('attachment_rate'))
     link_importer = LinkImporter(target)
+    prefetcher = AttachmentPrefetcher(
+        lambda: connect(source_url, source_login, source_password, source_token),
+        lambda: connect(target_url, target_login, target_password, target_token),
+        params.get('attachment_workers', DEFAULT_WORKERS))
 
     # create all projects with minimum info and project lead set
     created_projects = []
@@ -312,7 +617,9 @@ def youtrack2youtrack(source_url, source_login, source_password, target_url, tar
     for project_id in project_ids:
         cf_names_to_import.update([pcf.name.capitalize() for pcf in source.getProjectCustomFields(project_id)])
 
-    target_cf_names = [pcf.name.capitalize() for pcf in target.getCustomFields()]
+    custom_fields_done = journal.is_done('custom_fields')
+    if not custom_fields_done:
+        target_cf_names = [pcf.name.capitalize() for pcf in target.getCustomFields()]
 
     period_cf_names = []
 
@@ -320,6 +627,8 @@ def youtrack2youtrack(source_url, source_login, source_password, target_url, tar
         source_cf = source.getCustomField(cf_name)
         if source_cf.type.lower() == 'period':
             period_cf_names.append(source_cf.name.lower())
+        if custom_fields_done:
+            continue
 
         print("Processing custom field '%s'" % utf8encode(cf_name))
         if cf_name in target_cf_names:
@@ -334,8 +643,11 @@ def youtrack2youtrack(source_url, source_login, source_password, target_url, tar
             if hasattr(source_cf, "defaultBundle"):
                 create_bundle_from_bundle(source, target, source_cf.defaultBundle, source_cf.type, user_importer)
             target.createCustomField(source_cf)
+    journal.done('custom_fields')
 
     failed_commands = []
+    # authors of workitems that were imported already
+    workitem_authors = set([])
 
     for projectId in project_ids:
         source = Connection(source_url, source_login, source_password) if (source_token is None) else Connection(
@@ -350,36 +662,46 @@ def youtrack2youtrack(source_url, source_login, source_password, target_url, tar
         # copy project, subsystems, versions
         project = source.getProject(projectId)
 
-        link_importer.addAvailableIssuesFrom(projectId)
+        project_query = query
+        if sync_state is None:
+            link_importer.addAvailableIssuesFrom(projectId)
+        else:
+            last_updates[projectId] = get_last_update(source, projectId)
+            since = sync_state.get_position(projectId)
+            if since is not None:
+                project_query = updated_since_query(query, int(since))
+                print("Import issues matching [ %s ]" % project_query)
         project_custom_fields = source.getProjectCustomFields(projectId)
-        # create bundles and additional values
-        for pcf_ref in project_custom_fields:
-            pcf = source.getProjectCustomField(projectId, pcf_ref.name)
-            if hasattr(pcf, "bundle"):
-                try:
-                    create_bundle_from_bundle(source, target, pcf.bundle, source.getCustomField(pcf.name).type,
-                                              user_importer)
-                except youtrack.YouTrackException as e:
-                    if e.response.status != 409:
-                        raise e
-                    else:
-                        print(e)
+        if not journal.is_done('fields:' + projectId):
+            # create bundles and additional values
+            for pcf_ref in project_custom_fields:
+                pcf = source.getProjectCustomField(projectId, pcf_ref.name)
+                if hasattr(pcf, "bundle"):
+                    try:
+                        create_bundle_from_bundle(source, target, pcf.bundle, source.getCustomField(pcf.name).type,
+                                                  user_importer)
+                    except youtrack.YouTrackException as e:
+                        if e.response.status != 409:
+                            raise e
+                        else:
+                            print(e)
 
-        target_project_fields = [pcf.name.lower() for pcf in target.getProjectCustomFields(projectId)]
-        for field in project_custom_fields:
-            if field.name.lower() in target_project_fields:
-                if hasattr(field, 'bundle'):
-                    if field.bundle != target.getProjectCustomField(projectId, field.name).bundle:
-                        target.deleteProjectCustomField(projectId, field.name)
+            target_project_fields = [pcf.name.lower() for pcf in target.getProjectCustomFields(projectId)]
+            for field in project_custom_fields:
+                if field.name.lower() in target_project_fields:
+                    if hasattr(field, 'bundle'):
+                        if field.bundle != target.getProjectCustomField(projectId, field.name).bundle:
+                            target.deleteProjectCustomField(projectId, field.name)
+                            create_project_custom_field(target, field, projectId)
+                else:
+                    try:
                         create_project_custom_field(target, field, projectId)
-            else:
-                try:
-                    create_project_custom_field(target, field, projectId)
-                except youtrack.YouTrackException as e:
-                    if e.response.status != 409:
-                        raise e
-                    else:
-                        print(e)
+                    except youtrack.YouTrackException as e:
+                        if e.response.status != 409:
+                            raise e
+                        else:
+                            print(e)
+            journal.done('fields:' + projectId)
 
         # copy issues
         start = 0
@@ -387,18 +709,39 @@ def youtrack2youtrack(source_url, source_login, source_password, target_url, tar
 
         sync_workitems = enable_time_tracking(source, target, projectId)
         tt_settings = target.getProjectTimeTrackingSettings(projectId)
+        if params.get('sync_custom_fields'):
+            skip_fields = []
+            if tt_settings and tt_settings.Enabled and tt_settings.TimeSpentField:
+                skip_fields.append(tt_settings.TimeSpentField.lower())
+            sync_fields = [pcf for pcf in project_custom_fields
+                           if pcf.name.lower() not in skip_fields]
+            target_fields = dict([(pcf.name.lower(), pcf)
+                                  for pcf in target.getProjectCustomFields(projectId)])
 
         print("Import issues")
         last_created_issue_number = 0
+        # Issues before this position were imported by the interrupted run,
+        # only their links and attachments are processed again
+        imported_position = int(journal.get_position(projectId, 0))
 
         while True:
             try:
                 print("Get issues from " + str(start) + " to " + str(start + max))
-                issues = source.getIssues(projectId, query, start, max)
+                issues = source.getIssues(projectId, project_query, start, max)
 
                 if len(issues) <= 0:
                     break
 
+                if start < imported_position:
+                    prefetcher.prefetch(issues)
+                    for issue in issues:
+                        link_importer.collectLinks(issue.getLinks(True))
+                        transfer_issue_attachments(target, issue, user_importer, uploader, journal, params,
+                                                   prefetcher)
+                    link_importer.addAvailableIssues(issues)
+                    start += max
+                    continue
+
                 if convert_period_values and period_cf_names:
                     for issue in issues:
                         for pname in period_cf_names:
@@ -443,13 +786,18 @@ def youtrack2youtrack(source_url, source_login, source_password, target_url, tar
                     print(target.importIssues(projectId, project.name + ' Assignees', issues))
                 link_importer.addAvailableIssues(issues)
 
+                target_issues = get_target_issues(target, projectId, issues)
+                prefetcher.prefetch(issues)
+                comment_updates = []
                 for issue in issues:
-                    try:
-                        target_issue = target.getIssue(issue.id)
-                    except youtrack.YouTrackException as e:
-                        print("Cannot get target issue")
-                        print(e)
-                        continue
+                    target_issue = target_issues.get(issue.id)
+                    if target_issue is None:
+                        try:
+                            target_issue = target.getIssue(issue.id)
+                        except youtrack.YouTrackException as e:
+                            print("Cannot get target issue")
+                            print(e)
+                            continue
 
                     if params.get('sync_tags') and issue.tags:
                         try:
@@ -465,163 +813,43 @@ def youtrack2youtrack(source_url, source_login, source_password, target_url, tar
                             print(e)
 
                     if params.get('add_new_comments'):
-                        target_comments = dict()
-                        max_id = 0
-                        for c in target_issue.getComments():
-                            target_comments[c.created] = c
-                            if max_id < c.created:
-                                max_id = c.created
-                        for c in issue.getComments():
-                            if c.created > max_id or c.created not in target_comments:
-                                group = None
-                                if hasattr(c, 'permittedGroup'):
-                                    group = c.permittedGroup
-                                try:
-                                    target.executeCommand(issue.id, 'comment', c.text, group, c.author,
-                                                          disable_notifications=True)
-                                except youtrack.YouTrackException as e:
-                                    print('Cannot add comment to issue')
-                                    print(e)
+                        new_comments = get_new_comments(issue, target_issue)
+                        if new_comments and params.get('import_comments'):
+                            comment_updates.append(copy.copy(issue))
+                            comment_updates[-1].comments = new_comments
+                        else:
+                            add_comments(target, issue.id, new_comments)
 
                     if params.get('sync_custom_fields'):
-                        skip_fields = []
-                        if tt_settings and tt_settings.Enabled and tt_settings.TimeSpentField:
-                            skip_fields.append(tt_settings.TimeSpentField)
-                        skip_fields = [name.lower() for name in skip_fields]
-                        for pcf in [pcf for pcf in project_custom_fields if pcf.name.lower() not in skip_fields]:
-                            target_cf_value = None
-                            if pcf.name in target_issue:
-                                target_cf_value = target_issue[pcf.name]
-                                if isinstance(target_cf_value, (list, tuple)):
-                                    target_cf_value = set(target_cf_value)
-                                elif target_cf_value == target.getProjectCustomField(projectId, pcf.name).emptyText:
-                                    target_cf_value = None
-                            source_cf_value = None
-                            if pcf.name in issue:
-                                source_cf_value = issue[pcf.name]
-                                if isinstance(source_cf_value, (list, tuple)):
-                                    source_cf_value = set(source_cf_value)
-                                elif source_cf_value == source.getProjectCustomField(projectId, pcf.name).emptyText:
-                                    source_cf_value = None
-                            if source_cf_value == target_cf_value:
-                                continue
-                            if isinstance(source_cf_value, set) or isinstance(target_cf_value, set):
-                                if source_cf_value is None:
-                                    source_cf_value = set([])
-                                elif not isinstance(source_cf_value, set):
-                                    source_cf_value = set([source_cf_value])
-                                if target_cf_value is None:
-                                    target_cf_value = set([])
-                                elif not isinstance(target_cf_value, set):
-                                    target_cf_value = set([target_cf_value])
-                                for v in target_cf_value:
-                                    if v not in source_cf_value:
-                                        target.executeCommand(issue.id, 'remove %s %s' % (pcf.name, v),
-                                                              disable_notifications=True)
-                                for v in source_cf_value:
-                                    if v not in target_cf_value:
-                                        target.executeCommand(issue.id, 'add %s %s' % (pcf.name, v),
-                                                              disable_notifications=True)
-                            else:
-                                if source_cf_value is None:
-                                    source_cf_value = target.getProjectCustomField(projectId, pcf.name).emptyText
-                                if pcf.type.lower() == 'date':
-                                    m = re.match(r'(\d{10})(?:\d{3})?', str(source_cf_value))
-                                    if m:
-                                        source_cf_value = datetime.datetime.fromtimestamp(
-                                            int(m.group(1))).strftime('%Y-%m-%d')
-                                elif pcf.type.lower() == 'period':
-                                    source_cf_value = '%sm' % source_cf_value
-                                command = '%s %s' % (pcf.name, source_cf_value)
-                                try:
-                                    target.executeCommand(issue.id, command, disable_notifications=True)
-                                except youtrack.YouTrackException as e:
-                                    if e.response.status == 412 and e.response.reason.find('Precondition Failed') > -1:
-                                        print('WARN: Some workflow blocks following command: %s' % command)
-                                        failed_commands.append((issue.id, command))
+                        execute_field_commands(
+                            target, issue.id,
+                            get_field_commands(issue, target_issue, sync_fields, target_fields),
+                            failed_commands)
 
                     if sync_workitems:
-                        workitems = source.getWorkItems(issue.id)
-                        if workitems:
-                            existing_workitems = dict()
-                            target_workitems = target.getWorkItems(issue.id)
-                            if target_workitems:
-                                for w in target_workitems:
-                                    _id = '%s\n%s\n%s' % (w.date, w.authorLogin, w.duration)
-                                    if hasattr(w, 'description'):
-                                        _id += '\n%s' % w.description
-                                    existing_workitems[_id] = w
-                            new_workitems = []
-                            for w in workitems:
-                                _id = '%s\n%s\n%s' % (w.date, w.authorLogin, w.duration)
-                                if hasattr(w, 'description'):
-                                    _id += '\n%s' % w.description
-                                if _id not in existing_workitems:
-                                    new_workitems.append(w)
-                            if new_workitems:
-                                print("Process workitems for issue [ " + issue.id + "]")
-                                try:
-                                    user_importer.importUsersRecursively(
-                                        [source.getUser(w.authorLogin)
-                                         for w in new_workitems])
-                                    target.importWorkItems(issue.id, new_workitems)
-                                except youtrack.YouTrackException as e:
-                                    if e.response.status == 404:
-                                        print("WARN: Target YouTrack doesn't support workitems importing.")
-                                        print("WARN: Workitems won't be imported.")
-                                        sync_workitems = False
-                                    else:
-                                        print("ERROR: Skipping workitems because of error:" + str(e))
-
-                    print("Process attachments for issue [%s]" % issue.id)
-                    existing_attachments = dict()
-                    try:
-                        for a in target.getAttachments(issue.id):
-                            existing_attachments[a.name + '\n' + a.created] = a
-                    except youtrack.YouTrackException as e:
-                        if e.response.status == 404:
-                            print("Skip importing attachments because issue %s doesn't exist" % issue.id)
-                            continue
-                        raise e
-
-                    attachments = []
-
-                    users = set([])
-                    for a in issue.getAttachments():
-                        if a.name + '\n' + a.created in existing_attachments and not params.get('replace_attachments'):
-                            a.name = utf8encode(a.name)
+                        new_workitems = get_new_workitems(source, target, issue.id, issue.id)
+                        if new_workitems:
+                            print("Process workitems for issue [ " + issue.id + "]")
                             try:
-                                print("Skip attachment '%s' (created: %s) because it's already exists"
-                                      % (utf8encode(a.name), utf8encode(a.created)))
-                            except Exception:
-                                pass
-                            continue
-                        attachments.append(a)
-                        author = a.getAuthor()
-                        if author is not None:
-                            users.add(author)
-                    user_importer.importUsersRecursively(users)
-
-                    for a in attachments:
-                        print("Transfer attachment of " + utf8encode(issue.id) + ": " + utf8encode(a.name))
-                        # TODO: add authorLogin to workaround http://youtrack.jetbrains.net/issue/JT-6082
-                        # a.authorLogin = target_login
-                        try:
-                            target.createAttachmentFromAttachment(issue.id, a)
-                        except BaseException as e:
-                            print("Cant import attachment [ %s ]" % utf8encode(a.name))
-                            print(repr(e))
-                            continue
-                        if params.get('replace_attachments'):
-                            try:
-                                old_attachment = existing_attachments.get(a.name + '\n' + a.created)
-                                if old_attachment:
-                                    print('Deleting old attachment')
-                                    target.deleteAttachment(issue.id, old_attachment.id)
-                            except BaseException as e:
-                                print("Cannot delete attachment '%s' from issue %s" % (
-                                utf8encode(a.name), utf8encode(issue.id)))
-                                print(e)
+                                authors = get_authors(new_workitems, workitem_authors)
+                                if authors:
+                                    user_importer.importUsersRecursively(
+                                        [source.getUser(login) for login in authors])
+                                    workitem_authors.update(authors)
+                                target.importWorkItems(issue.id, new_workitems)
+                            except youtrack.YouTrackException as e:
+                                if e.response.status == 404:
+                                    print("WARN: Target YouTrack doesn't support workitems importing.")
+                                    print("WARN: Workitems won't be imported.")
+                                    sync_workitems = False
+                                else:
+                                    print("ERROR: Skipping workitems because of error:" + str(e))
+
+                    transfer_issue_attachments(target, issue, user_importer, uploader, journal, params,
+                                               prefetcher)
+
+                if comment_updates:
+                    import_comments(target, projectId, project.name + ' Assignees', comment_updates)
 
             except Exception as e:
                 print('Cant process issues from ' + str(start) + ' to ' + str(start + max))
@@ -629,9 +857,21 @@ def youtrack2youtrack(source_url, source_login, source_password, target_url, tar
                 raise e
 
             start += max
+            journal.set_position(projectId, start)
 
+    uploader.join()
+    prefetcher.close()
     print("Import issue links")
-    link_importer.importCollectedLinks()
+    if sync_state is not None:
+        add_existing_link_ends(target, link_importer)
+    links = [link for link in link_importer.links
+             if not journal.has('link', link_key(link))]
+    link_importer.links = []
+    for i in range(0, len(links), 100):
+        chunk = links[i:i + 100]
+        link_importer.importLinks(chunk)
+        journal.add_all('link', [link_key(link) for link in chunk
+                                 if link_importer.checkLink(link)])
 
     print("Trying to execute failed commands once again")
     for issue_id, command in failed_commands:
@@ -641,6 +881,140 @@ def youtrack2youtrack(source_url, source_login, source_password, target_url, tar
         except youtrack.YouTrackException as e:
             print('Failed to execute command for issue #%s: %s' % (issue_id, command))
             print(e)
+    if sync_state is not None:
+        # Saved only when everything is imported, an interrupted run is
+        # repeated from the same point
+        for project_id, last_update in last_updates.items():
+            if last_update is not None:
+                sync_state.set_position(project_id, last_update)
+        sync_state.close()
+    journal.close()
+
+
+def attachment_key(issue_id, attachment):
+    return u'%s\n%s\n%s' % (issue_id, attachment.name, attachment.created)
+
+
+def is_same_file(attachment, other):
+    size = getattr(attachment, 'size', None)
+    return size is not None and size == getattr(other, 'size', None)
+
+
+def transfer_issue_attachments(target, issue, user_importer, uploader, journal, params,
+                               prefetcher=None):
+    attachments = [a for a in issue.getAttachments()
+                   if not journal.has('attachment', attachment_key(issue.id, a))]
+    if not attachments:
+        return
+    print('Process attachments for issue %s' % issue.id)
+    try:
+        if prefetcher is not None:
+            target_attachments = prefetcher.get_target_attachments(target, issue.id)
+        else:
+            target_attachments = target.getAttachments(issue.id)
+    except youtrack.YouTrackException as e:
+        if e.response.status == 404:
+            print("Skip importing attachments because issue %s doesn't exist" % issue.id)
+            return
+        raise e
+    existing_attachments = dict([((a.name, a.created), a) for a in target_attachments])
+
+    users = set([])
+    new_attachments = []
+    for a in attachments:
+        old_attachment = existing_attachments.get((a.name, a.created))
+        if old_attachment is not None:
+            # With -r only attachments that differ in size are replaced
+            if not params.get('replace_attachments') or is_same_file(a, old_attachment):
+                print("Skip attachment '%s' (created: %s) because it's already exists" %
+                      (utf8encode(a.name), utf8encode(a.created)))
+                journal.add('attachment', attachment_key(issue.id, a))
+                continue
+        new_attachments.append((a, old_attachment))
+        author = a.getAuthor()
+        if author is not None:
+            users.add(author)
+    user_importer.importUsersRecursively(users)
+
+    for a, old_attachment in new_attachments:
+        print('Transfer attachment of %s: %s' % (utf8encode(issue.id), utf8encode(a.name)))
+        # TODO: add authorLogin to workaround http://youtrack.jetbrains.net/issue/JT-6082
+        # a.authorLogin = target_login
+        transfer_attachment(uploader, target, issue.id, a, journal, old_attachment)
+
+
+class AttachmentPrefetcher(object):
+    """Requests attachments of a page of issues from both instances at once.
+
+    Requests run in a pool of threads that have connections of their own,
+    as the connections used by the rest of the import can't be shared.
+    Source attachments are stored in the issues, target ones are returned
+    by get_target_attachments(). Failed requests are repeated there with
+    the connection of the caller.
+    """
+
+    def __init__(self, connect_source, connect_target, workers=DEFAULT_WORKERS):
+        self._connect = dict(source=connect_source, target=connect_target)
+        self._local = threading.local()
+        self._pool = ThreadPool(max(1, workers))
+        self._target_attachments = dict([])
+
+    def prefetch(self, issues):
+        tasks = [('target', issue.id) for issue in issues]
+        tasks += [('source', issue.id) for issue in issues
+                  if getattr(issue, 'attachments', None) is None]
+        results = dict(zip(tasks, self._pool.map(self._get_attachments, tasks)))
+        for issue in issues:
+            attachments = results.get(('source', issue.id))
+            if isinstance(attachments, list):
+                issue.attachments = attachments
+        self._target_attachments = dict([(issue.id, results[('target', issue.id)])
+                                         for issue in issues])
+
+    def get_target_attachments(self, target, issue_id):
+        result = self._target_attachments.pop(issue_id, None)
+        if result is None:
+            return target.getAttachments(issue_id)
+        if isinstance(result, youtrack.YouTrackException):
+            raise result
+        return result
+
+    def close(self):
+        self._pool.close()
+
+    def _get_attachments(self, task):
+        kind, issue_id = task
+        try:
+            connection = getattr(self._local, kind, None)
+            if connection is None:
+                connection = self._connect[kind]()
+                setattr(self._local, kind, connection)
+            return connection.getAttachments(issue_id)
+        except youtrack.YouTrackException as e:
+            return e if e.response.status == 404 else None
+        except Exception:
+            return None
+
+
+def transfer_attachment(uploader, target, issue_id, attachment, journal, old_attachment=None):
+    def on_done(ok):
+        if not ok:
+            return
+        journal.add('attachment', attachment_key(issue_id, attachment))
+        if old_attachment is None:
+            return
+        try:
+            print('Deleting old attachment')
+            target.deleteAttachment(issue_id, old_attachment.id)
+        except BaseException as e:
+            print("Cannot delete attachment '%s' from issue %s" % (
+                utf8encode(attachment.name), utf8encode(issue_id)))
+            print(e)
+
+    uploader.submit(
+        issue_id, attachment.name,
+        lambda: import_from_attachment(target, issue_id, attachment),
+        on_done=on_done)
 
 
 def import_attachments_only(source_url, source_login, source_password,
@@ -651,7 +1025,6 @@ def import_attachments_only(source_url, source_login, source_password,
         return
     if params is None:
         params = {}
-    start = 0
     max = 20
     source = Connection(source_url, source_login, source_password) if (source_token is None) else Connection(source_url,
                                                                                                              token=source_token)
@@ -659,62 +1032,35 @@ def import_attachments_only(source_url, source_login, source_password,
                                                                                                              token=target_token)
 
     user_importer = UserImporter(source, target, caching_users=params.get('enable_user_caching', True))
+    uploader = AttachmentUploader(
+        target_url,
+        workers=params.get('attachment_workers', DEFAULT_WORKERS),
+        rate=params.get('attachment_rate'))
+    journal = Journal(journal_path('youtrack2youtrack_attachments'), params.get('resume'))
+    prefetcher = AttachmentPrefetcher(
+        lambda: connect(source_url, source_login, source_password, source_token),
+        lambda: connect(target_url, target_login, target_password, target_token),
+        params.get('attachment_workers', DEFAULT_WORKERS))
     for projectId in project_ids:
+        start = 0
         while True:
             try:
                 print('Get issues from %d to %d' % (start, start + max))
                 issues = source.getIssues(projectId, '', start, max)
                 if len(issues) <= 0:
                     break
+                prefetcher.prefetch(issues)
                 for issue in issues:
-                    print('Process attachments for issue %s' % issue.id)
-                    existing_attachments = dict()
-                    try:
-                        for a in target.getAttachments(issue.id):
-                            existing_attachments[a.name + '\n' + a.created] = a
-                    except youtrack.YouTrackException as e:
-                        if e.response.status == 404:
-                            print("Skip importing attachments because issue %s doesn't exist" % issue.id)
-                            continue
-                        raise e
-
-                    attachments = []
-
-                    users = set([])
-                    for a in issue.getAttachments():
-                        if a.name + '\n' + a.created in existing_attachments and not params.get('replace_attachments'):
-                            print("Skip attachment '%s' (created: %s) because it's already exists" %
-                                  (utf8encode(a.name), utf8encode(a.created)))
-                            continue
-                        attachments.append(a)
-                        author = a.getAuthor()
-                        if author is not None:
-                            users.add(author)
-                    user_importer.importUsersRecursively(users)
-
-                    for a in attachments:
-                        print('Transfer attachment of %s: %s' % (utf8encode(issue.id), utf8encode(a.name)))
-                        try:
-                            target.createAttachmentFromAttachment(issue.id, a)
-                        except BaseException as e:
-                            print('Cannot import attachment [ %s ]' % utf8encode(a.name))
-                            print(repr(e))
-                            continue
-                        if params.get('replace_attachments'):
-                            try:
-                                old_attachment = existing_attachments.get(a.name + '\n' + a.created)
-                                if old_attachment:
-                                    print('Deleting old attachment')
-                                    target.deleteAttachment(issue.id, old_attachment.id)
-                            except BaseException as e:
-                                print("Cannot delete attachment '%s' from issue %s" % (
-                                utf8encode(a.name), utf8encode(issue.id)))
-                                print(e)
+                    transfer_issue_attachments(target, issue, user_importer, uploader, journal, params,
+                                               prefetcher)
             except Exception as e:
                 print('Cannot process issues from %d to %d' % (start, start + max))
                 traceback.print_exc()
                 raise e
             start += max
+    uploader.join()
+    prefetcher.close()
+    journal.close()
 
 
 if __name__ == "__main__":